@@ -0,0 +1,692 @@
+# Copyright 2022 Michael Thornburgh
+# SPDX-License-Identifier: MIT
+
+# package TC audio and video messages (RFC 7425 §5.1.2, as received on a TC
+# RecvFlow) into fragmented MP4, for segmenting to CDNs and HLS/DASH. this is
+# the server side equivalent of mp4f.js.
+#
+# boxes are built in place in one growable bytearray: a box writes a
+# placeholder size when it's opened and patches it when it's closed, so a
+# fragment is assembled without copying nested boxes. FragmentMuxer emits an
+# init segment and then a moof+mdat fragment per GOP or per time slice.
+#
+# run as a script to benchmark muxing throughput for many concurrent streams.
+
+import argparse
+import struct
+import sys
+import time
+
+TIMESCALE = 90000
+
+TCMSG_AUDIO = 8
+TCMSG_VIDEO = 9
+
+TC_VIDEO_ENHANCED_FLAG_ISEXHEADER = 8 << 4
+TC_VIDEO_FRAMETYPE_IDR            = 1 << 4
+TC_VIDEO_FRAMETYPE_GENERATED_IDR  = 4 << 4
+TC_VIDEO_FRAMETYPE_MASK           = 0x70
+TC_VIDEO_CODEC_AVC                = 7
+TC_VIDEO_CODEC_MASK               = 0x0f
+TC_VIDEO_ENH_CODEC_AVC            = b"avc1"
+TC_VIDEO_AVCPACKET_AVCC           = 0
+TC_VIDEO_AVCPACKET_NALU           = 1
+TC_VIDEO_AVCPACKET_EOS            = 2
+TC_VIDEO_ENH_PACKETTYPE_SEQUENCE_START = 0
+TC_VIDEO_ENH_PACKETTYPE_CODED_FRAMES   = 1
+TC_VIDEO_ENH_PACKETTYPE_SEQUENCE_END   = 2
+TC_VIDEO_ENH_PACKETTYPE_CODED_FRAMES_X = 3
+TC_VIDEO_ENH_PACKETTYPE_MASK           = 0x0f
+
+TC_AUDIO_CODEC_AAC                    = 10 << 4
+TC_AUDIO_CODEC_EXHEADER               = 9 << 4
+TC_AUDIO_CODEC_MASK                   = 0xf0
+TC_AUDIO_ENH_CODEC_AAC                = b"mp4a"
+TC_AUDIO_AACPACKET_AUDIO_SPECIFIC_CONFIG = 0
+TC_AUDIO_AACPACKET_AUDIO_AAC          = 1
+TC_AUDIO_ENH_PACKETTYPE_SEQUENCE_START = 0
+TC_AUDIO_ENH_PACKETTYPE_CODED_FRAMES   = 1
+TC_AUDIO_ENH_PACKETTYPE_MASK           = 0x0f
+
+SAMPLE_FLAGS_SYNC     = 0x02000000 # sample_depends_on: does not depend on others
+SAMPLE_FLAGS_NON_SYNC = 0x01010000 # sample_depends_on: depends on others, sample_is_non_sync_sample
+
+AAC_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350, 0, 0, 0]
+
+U16 = struct.Struct("!H")
+U32 = struct.Struct("!I")
+U64 = struct.Struct("!Q")
+BOX_HEADER = struct.Struct("!I4s")
+TRUN_ENTRY = struct.Struct("!IIIi") # duration, size, flags, composition time offset
+
+
+class ExpGolomb(object):
+	def __init__(self, data, bit = 0):
+		self.data = data
+		self.bit = bit
+
+	def at(self, bit):
+		offset = bit // 8
+		if offset > len(self.data):
+			raise IndexError("buffer exceeded")
+		if offset == len(self.data):
+			return 0
+		return (self.data[offset] >> (7 - (bit % 8))) & 1
+
+	def nextBit(self):
+		rv = self.at(self.bit)
+		self.bit += 1
+		return rv
+
+	def nextValue(self):
+		moreBits = 0
+		while 0 == self.nextBit():
+			moreBits += 1
+		rv = 0
+		for x in range(moreBits):
+			rv = (rv << 1) + self.nextBit()
+		return (1 << moreBits) - 1 + rv
+
+	def nextSignedValue(self):
+		val = self.nextValue()
+		if val & 1:
+			return (val + 1) // 2
+		return -(val // 2)
+
+
+class MP4Box(object):
+	# a box appended to buffer (a bytearray). its size is patched by close(), and
+	# by leaving a with statement. children must be closed before their parent.
+
+	def __init__(self, boxType, buffer, version = None, flags = 0):
+		if 4 != len(boxType):
+			raise ValueError("box type must be exactly 4 bytes")
+		self.buffer = buffer
+		self.start = len(buffer)
+		buffer.extend(BOX_HEADER.pack(0, boxType))
+		if version is not None:
+			buffer.extend(U32.pack(((version & 0xff) << 24) | (flags & 0xffffff)))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.close()
+
+	def close(self):
+		U32.pack_into(self.buffer, self.start, len(self.buffer) - self.start)
+
+	def child(self, boxType, version = None, flags = 0):
+		return self.__class__(boxType, self.buffer, version, flags)
+
+	def append(self, data):
+		self.buffer.extend(data)
+
+	def appendU8(self, val):
+		self.buffer.append(val & 0xff)
+
+	def appendU16(self, val):
+		self.buffer.extend(U16.pack(val & 0xffff))
+
+	def appendU32(self, val):
+		self.buffer.extend(U32.pack(val & 0xffffffff))
+
+	def appendU64(self, val):
+		self.buffer.extend(U64.pack(val))
+
+	def appendU32Values(self, values):
+		# each value is either an int or a 4 byte type code
+		for each in values:
+			if isinstance(each, int):
+				self.appendU32(each)
+			else:
+				self.append(each)
+
+
+class MP4F(object):
+	videoTrackID = 1
+	audioTrackID = 2
+
+	def __init__(self):
+		self.sampleRate = 0
+		self.samplesPerAudioFrame = 0
+		self._nextSegmentNumber = 1
+
+	@staticmethod
+	def getVideoDimensionsFromSPS(sps):
+		profile_idc = sps[1]
+		level_idc = sps[3]
+		eg = ExpGolomb(sps, 4 * 8) # offset of seq_parameter_set_id
+
+		chromaArrayType = 0
+		eg.nextValue() # seq_parameter_set_id
+		if profile_idc in [100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135]:
+			chroma_format_idc = eg.nextValue()
+			chromaArrayType = chroma_format_idc
+			if 3 == chroma_format_idc:
+				if eg.nextBit(): # separate_colour_plane_flag
+					chromaArrayType = 0
+			eg.nextValue() # bit_depth_luma_minus8
+			eg.nextValue() # bit_depth_chroma_minus8
+			eg.nextBit() # qpprime_y_zero_transform_bypass_flag
+			if eg.nextBit(): # seq_scaling_matrix_present_flag better not be set
+				print("seq_scaling_matrix_present_flag set! better implement scaling_list syntax correctly to skip over it!")
+				eg.bit += 8 if 3 != chroma_format_idc else 12
+		eg.nextValue() # log2_max_frame_num_minus4
+		pic_order_cnt_type = eg.nextValue()
+		if 0 == pic_order_cnt_type:
+			eg.nextValue() # log2_max_pic_order_cnt_lsb_minus4
+		elif 1 == pic_order_cnt_type:
+			eg.nextBit() # delta_pic_order_always_zero_flag
+			eg.nextSignedValue() # offset_for_non_ref_pic
+			eg.nextSignedValue() # offset_for_top_to_bottom_field
+			for x in range(eg.nextValue()): # num_ref_frames_in_pic_order_cnt_cycle
+				eg.nextSignedValue() # offset_for_ref_frame[i]
+		eg.nextValue() # max_num_ref_frames
+		eg.nextBit() # gaps_in_frame_num_value_allowed_flag
+
+		pic_width_in_mbs_minus1 = eg.nextValue()
+		pic_height_in_map_units_minus1 = eg.nextValue()
+		width = (pic_width_in_mbs_minus1 + 1) * 16
+		height = pic_height_in_map_units_minus1 + 1
+		frame_mbs_only_flag = eg.nextBit()
+		height *= 16 if frame_mbs_only_flag else 8
+		if not frame_mbs_only_flag:
+			eg.nextBit() # mb_adaptive_frame_field_flag
+		eg.nextBit() # direct_8x8_inference_flag
+		if eg.nextBit(): # frame_cropping_flag
+			frame_crop_left_offset = eg.nextValue()
+			frame_crop_right_offset = eg.nextValue()
+			frame_crop_top_offset = eg.nextValue()
+			frame_crop_bottom_offset = eg.nextValue()
+
+			subWidthC = 1
+			subHeightC = 1
+			if 1 == chromaArrayType:
+				subWidthC = 2
+				subHeightC = 2
+			elif 2 == chromaArrayType:
+				subWidthC = 2
+
+			if 0 == chromaArrayType:
+				cropUnitX = 1
+				cropUnitY = 2 - frame_mbs_only_flag
+			else:
+				cropUnitX = subWidthC
+				cropUnitY = subHeightC * (2 - frame_mbs_only_flag)
+
+			width -= (frame_crop_left_offset + frame_crop_right_offset) * cropUnitX
+			height -= (frame_crop_top_offset + frame_crop_bottom_offset) * cropUnitY
+
+		return { "width": width, "height": height, "profile_idc": profile_idc, "level_idc": level_idc }
+
+	@classmethod
+	def getVideoDimensionsFromAVCC(cls, avcc):
+		sps_length = U16.unpack_from(avcc, 6)[0]
+		return cls.getVideoDimensionsFromSPS(avcc[8:8 + sps_length])
+
+	@staticmethod
+	def getAudioDimensionsFromAacAudioSpecificConfig(aacAudioSpecificConfig):
+		sampleRateIndex = ((aacAudioSpecificConfig[0] & 0x7) << 1) + ((aacAudioSpecificConfig[1] >> 7) & 0x1)
+		channelConfig = (aacAudioSpecificConfig[1] & 0x78) >> 3
+		channels = 8 if 7 == channelConfig else channelConfig
+		return { "channelConfig": channelConfig, "sampleRateIndex": sampleRateIndex, "channels": channels, "sampleRate": AAC_SAMPLE_RATES[sampleRateIndex] }
+
+	def makeInitSegment(self, avcc = None, aacAudioSpecificConfig = None):
+		dst = bytearray()
+
+		with MP4Box(b"ftyp", dst) as ftyp:
+			ftyp.appendU32Values([b"iso6", 0, b"isom", b"iso6", b"msdh"])
+
+		with MP4Box(b"moov", dst) as moov:
+			with moov.child(b"mvhd", 0, 0) as mvhd:
+				mvhd.appendU32Values([
+					0, 0, TIMESCALE, 0xffffffff, 0x10000, 0x01000000, 0, 0, # create, mod, tscale, dur, rate, vol, rsv
+					0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000, # unity matrix
+					0, 0, 0, 0, 0, 0, # reserved(6 U32)
+					0xffffffff # next trackID
+				])
+
+			if avcc:
+				self._addTrak(moov, self.videoTrackID, avcc = avcc)
+			if aacAudioSpecificConfig:
+				self._addTrak(moov, self.audioTrackID, aacAudioSpecificConfig = aacAudioSpecificConfig)
+
+			with moov.child(b"mvex") as mvex:
+				if avcc:
+					self._addTrex(mvex, self.videoTrackID)
+				if aacAudioSpecificConfig:
+					self._addTrex(mvex, self.audioTrackID)
+
+		return dst
+
+	def makeFrameSegment(self, trackID, dts, pts, duration, data):
+		# one access unit. times in seconds.
+		dts = int(round(dts * TIMESCALE))
+		return self.makeFragment([(trackID, dts, [(int(round(duration * TIMESCALE)), 0, int(round(pts * TIMESCALE)) - dts, data)])])
+
+	def makeFragment(self, trafs):
+		# trafs is a list of (trackID, baseMediaDecodeTime, samples), each sample a
+		# tuple of (duration, flags, compositionTimeOffset, data), times in TIMESCALE
+		# units. answer a moof with one traf per track, followed by one mdat.
+		dst = bytearray()
+		dataOffsetPositions = []
+
+		with MP4Box(b"moof", dst) as moof:
+			with moof.child(b"mfhd", 0, 0) as mfhd:
+				mfhd.appendU32(self._nextSegmentNumber)
+				self._nextSegmentNumber += 1
+
+			for trackID, baseMediaDecodeTime, samples in trafs:
+				with moof.child(b"traf") as traf:
+					with traf.child(b"tfhd", 0, 0x20000) as tfhd: # default-base-is-moof
+						tfhd.appendU32(trackID)
+
+					with traf.child(b"tfdt", 1, 0) as tfdt:
+						tfdt.appendU64(baseMediaDecodeTime)
+
+					with traf.child(b"trun", 1, 0xf01) as trun: # signed offsets, comp time, flags, size, duration, offset present
+						trun.appendU32(len(samples))
+						dataOffsetPositions.append(len(dst))
+						trun.appendU32(0) # will patch when we make the mdat
+						for duration, flags, compositionTimeOffset, data in samples:
+							dst.extend(TRUN_ENTRY.pack(duration, len(data), flags, max(-0x80000000, min(0x7fffffff, compositionTimeOffset))))
+
+		with MP4Box(b"mdat", dst):
+			for position, (trackID, baseMediaDecodeTime, samples) in zip(dataOffsetPositions, trafs):
+				U32.pack_into(dst, position, len(dst) - moof.start) # patch trun
+				for each in samples:
+					dst.extend(each[3])
+
+		return dst
+
+	def _addTrak(self, parent, trackID, avcc = None, aacAudioSpecificConfig = None):
+		videoDimensions = self.getVideoDimensionsFromAVCC(avcc) if avcc else { "width": 0, "height": 0 }
+
+		with parent.child(b"trak") as trak:
+			with trak.child(b"tkhd", 0, 7) as tkhd:
+				tkhd.appendU32Values([0, 0, trackID, 0, 0xffffffff, 0, 0, 0, 0x01000000, 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000])
+				tkhd.appendU32Values([videoDimensions["width"] * 65536, videoDimensions["height"] * 65536])
+
+			with trak.child(b"mdia") as mdia:
+				with mdia.child(b"mdhd", 0, 0) as mdhd:
+					mdhd.appendU32Values([0, 0, TIMESCALE, 0xffffffff, 0x55c40000]) # creat, mod, tscale, dur, lang | 0
+
+				with mdia.child(b"hdlr", 0, 0) as hdlr:
+					if aacAudioSpecificConfig:
+						hdlr.appendU32Values([0, b"soun", 0, 0, 0])
+						hdlr.append(b"audio track\0")
+					else:
+						hdlr.appendU32Values([0, b"vide", 0, 0, 0])
+						hdlr.append(b"video track\0")
+
+				with mdia.child(b"minf") as minf:
+					if aacAudioSpecificConfig:
+						with minf.child(b"smhd", 0, 0) as smhd:
+							smhd.appendU32(0) # balance, reserved
+					else:
+						with minf.child(b"vmhd", 0, 1) as vmhd:
+							vmhd.appendU32Values([0, 0]) # mode:copy, opcolor:(0,0,0)
+
+					with minf.child(b"dinf") as dinf:
+						with dinf.child(b"dref", 0, 0) as dref:
+							dref.appendU32(1)
+							dref.child(b"url ", 0, 1).close()
+
+					with minf.child(b"stbl") as stbl:
+						for boxType, values in [(b"stts", [0]), (b"ctts", [0]), (b"stsc", [0]), (b"stsz", [0, 0]), (b"stco", [0])]:
+							with stbl.child(boxType, 0, 0) as box:
+								box.appendU32Values(values)
+						self._addStsd(stbl, avcc, aacAudioSpecificConfig, videoDimensions)
+
+	def _addStsd(self, stbl, avcc, aacAudioSpecificConfig, videoDimensions):
+		with stbl.child(b"stsd", 0, 0) as stsd:
+			stsd.appendU32(1) # one entry
+			if aacAudioSpecificConfig:
+				audioDimensions = self.getAudioDimensionsFromAacAudioSpecificConfig(aacAudioSpecificConfig)
+				self.sampleRate = audioDimensions["sampleRate"]
+				self.samplesPerAudioFrame = 1024
+
+				with stsd.child(b"mp4a") as mp4a:
+					mp4a.appendU64(1)
+					mp4a.appendU32Values([
+						0, 0,
+						(audioDimensions["channels"] << 16) + 16, # channels | sample-size=16
+						0, # reserved
+						audioDimensions["sampleRate"] << 16
+					])
+
+					with mp4a.child(b"esds", 0, 0) as esds:
+						esds.append(bytes([
+							0x03, # tag
+							23 + len(aacAudioSpecificConfig),
+							0, 2, # esID
+							0, # pri + flags
+								0x04, # tag
+								15 + len(aacAudioSpecificConfig),
+								0x40, 0x15, # profile:0x40 audio:0x05
+								0xff, 0xff, 0xff, # buffer size
+								0, 0, 0xff, 0xff, 0, 0, 0xff, 0xff, # max & average bit rates
+									0x05, # tag
+									len(aacAudioSpecificConfig)
+						]))
+						esds.append(aacAudioSpecificConfig)
+						esds.append(b"\x06\x01\x02")
+			elif avcc:
+				with stsd.child(b"avc1") as avc1:
+					avc1.appendU64(1)
+					avc1.appendU32Values([0, 0, 0, 0])
+					avc1.appendU16(videoDimensions["width"])
+					avc1.appendU16(videoDimensions["height"])
+					avc1.appendU32Values([0x480000, 0x480000, 0]) # resolutions, 72dpi h/v
+					avc1.appendU16(1)
+					avc1.appendU32Values([
+						0, 0, 0, 0, 0, 0, 0, 0, # compressor name
+						0x0018ffff # depth, -1
+					])
+
+					with avc1.child(b"avcC") as avcC:
+						avcC.append(avcc)
+			else:
+				raise ValueError("missing audio or video config")
+
+	def _addTrex(self, parent, trackID):
+		with parent.child(b"trex", 0, 0) as trex:
+			trex.appendU32Values([trackID, 1, 1, 0, 0])
+
+
+class _Track(object):
+	def __init__(self, trackID, isVideo):
+		self.trackID = trackID
+		self.isVideo = isVideo
+		self.config = None
+		self.pending = None # [dts, flags, compositionTimeOffset, data], duration not yet known
+		self.samples = [] # ready for the next fragment
+		self.baseDecodeTime = 0
+		self.lastDuration = 0
+		self.needKeyFrame = True
+
+
+class FragmentMuxer(object):
+	# stream TC audio (AAC) and video (AVC) messages to fragmented MP4. calls
+	# oninitsegment(muxer, data) before the first fragment and whenever a codec
+	# configuration changes, and onfragment(muxer, data, startTime, duration)
+	# (in seconds) for each moof+mdat. a sample is held until the next sample on
+	# its track arrives and tells its duration.
+
+	fragmentOnKeyFrame = True # cut a fragment at each video keyframe (per GOP)
+	maxFragmentDuration = 2.0 # also cut after this many seconds (per time slice). 0 for no limit
+	defaultFrameRate = 30.0   # for the duration of a final video frame that can't be measured
+
+	def __init__(self):
+		self.oninitsegment = None
+		self.onfragment = None
+		self.mp4f = MP4F()
+		self._video = _Track(MP4F.videoTrackID, True)
+		self._audio = _Track(MP4F.audioTrackID, False)
+		self._initSegmentNeeded = True
+		self._fragmentStart = None
+		self._lastTimestamp = None
+		self._extendedTimestamp = 0
+
+	def appendMessage(self, message):
+		# message is a complete TC message: <u8 type> <u32 timestamp ms> <payload>
+		if len(message) < 6:
+			return
+		message = memoryview(message) # sample data is sliced from the message without copying
+		messageType = message[0]
+		if TCMSG_VIDEO == messageType:
+			self._onVideoMessage(self._unwrapTimestamp(U32.unpack_from(message, 1)[0]), message)
+		elif TCMSG_AUDIO == messageType:
+			self._onAudioMessage(self._unwrapTimestamp(U32.unpack_from(message, 1)[0]), message)
+
+	def attachRecvFlow(self, recvFlow):
+		# mux the TC media messages received on recvFlow, and flush when it completes
+		onmessage = recvFlow.onmessage
+		oncomplete = recvFlow.oncomplete
+
+		def _onmessage(flow, message, messageNumber):
+			if not isinstance(message, str):
+				self.appendMessage(message)
+			if onmessage:
+				onmessage(flow, message, messageNumber)
+
+		def _oncomplete(flow):
+			self.flush()
+			if oncomplete:
+				oncomplete(flow)
+
+		recvFlow.onmessage = _onmessage
+		recvFlow.oncomplete = _oncomplete
+
+	def flush(self):
+		# emit everything held, estimating the durations of the final samples
+		for track in [self._video, self._audio]:
+			if track.pending:
+				duration = track.lastDuration or self._defaultDuration(track)
+				self._readySample(track, track.pending, duration)
+				track.pending = None
+		self._emitFragment()
+
+	def _unwrapTimestamp(self, timestamp):
+		# TC timestamps are 32 bit milliseconds. answer TIMESCALE units that don't wrap.
+		if self._lastTimestamp is not None:
+			delta = (timestamp - self._lastTimestamp) & 0xffffffff
+			if delta >= 0x80000000:
+				delta -= 0x100000000
+			self._extendedTimestamp += delta
+		else:
+			self._extendedTimestamp = timestamp
+		self._lastTimestamp = timestamp
+		return self._extendedTimestamp * (TIMESCALE // 1000)
+
+	def _onVideoMessage(self, dts, message):
+		frameByte = message[5]
+		frameType = frameByte & TC_VIDEO_FRAMETYPE_MASK
+		keyFrame = frameType in [TC_VIDEO_FRAMETYPE_IDR, TC_VIDEO_FRAMETYPE_GENERATED_IDR]
+
+		if frameByte & TC_VIDEO_ENHANCED_FLAG_ISEXHEADER:
+			if (len(message) < 10) or (TC_VIDEO_ENH_CODEC_AVC != bytes(message[6:10])):
+				return # only AVC is supported
+			packetType = frameByte & TC_VIDEO_ENH_PACKETTYPE_MASK
+			if TC_VIDEO_ENH_PACKETTYPE_SEQUENCE_START == packetType:
+				self._setConfig(self._video, message[10:])
+			elif (TC_VIDEO_ENH_PACKETTYPE_CODED_FRAMES == packetType) and (len(message) >= 13):
+				self._addSample(self._video, dts, keyFrame, self._compositionTimeOffset(message, 10), message[13:])
+			elif TC_VIDEO_ENH_PACKETTYPE_CODED_FRAMES_X == packetType:
+				self._addSample(self._video, dts, keyFrame, 0, message[10:])
+			elif TC_VIDEO_ENH_PACKETTYPE_SEQUENCE_END == packetType:
+				self.flush()
+			return
+
+		if (TC_VIDEO_CODEC_AVC != frameByte & TC_VIDEO_CODEC_MASK) or (len(message) < 10):
+			return
+		avcPacketType = message[6]
+		if TC_VIDEO_AVCPACKET_AVCC == avcPacketType:
+			self._setConfig(self._video, message[10:])
+		elif TC_VIDEO_AVCPACKET_NALU == avcPacketType:
+			self._addSample(self._video, dts, keyFrame, self._compositionTimeOffset(message, 7), message[10:])
+		elif TC_VIDEO_AVCPACKET_EOS == avcPacketType:
+			self.flush()
+
+	def _onAudioMessage(self, dts, message):
+		soundByte = message[5]
+		codec = soundByte & TC_AUDIO_CODEC_MASK
+
+		if TC_AUDIO_CODEC_EXHEADER == codec:
+			if (len(message) < 10) or (TC_AUDIO_ENH_CODEC_AAC != bytes(message[6:10])):
+				return # only AAC is supported
+			packetType = soundByte & TC_AUDIO_ENH_PACKETTYPE_MASK
+			if TC_AUDIO_ENH_PACKETTYPE_SEQUENCE_START == packetType:
+				self._setConfig(self._audio, message[10:])
+			elif TC_AUDIO_ENH_PACKETTYPE_CODED_FRAMES == packetType:
+				self._addSample(self._audio, dts, True, 0, message[10:])
+			return
+
+		if (TC_AUDIO_CODEC_AAC != codec) or (len(message) < 7):
+			return
+		aacPacketType = message[6]
+		if TC_AUDIO_AACPACKET_AUDIO_SPECIFIC_CONFIG == aacPacketType:
+			if len(message) >= 9:
+				self._setConfig(self._audio, message[7:])
+		elif TC_AUDIO_AACPACKET_AUDIO_AAC == aacPacketType:
+			self._addSample(self._audio, dts, True, 0, message[7:])
+
+	def _compositionTimeOffset(self, message, cursor):
+		offset = (message[cursor] << 16) + (message[cursor + 1] << 8) + message[cursor + 2]
+		if offset & 0x800000:
+			offset -= 0x1000000
+		return offset * (TIMESCALE // 1000)
+
+	def _setConfig(self, track, config):
+		config = bytes(config)
+		if config == track.config:
+			return # repeated configurations are common, and don't start a new init segment
+		self.flush()
+		track.config = config
+		track.needKeyFrame = True
+		self._initSegmentNeeded = True
+
+	def _defaultDuration(self, track):
+		if track.isVideo:
+			return int(TIMESCALE / self.defaultFrameRate)
+		if self.mp4f.sampleRate:
+			return int(TIMESCALE * self.mp4f.samplesPerAudioFrame / self.mp4f.sampleRate)
+		return 0
+
+	def _addSample(self, track, dts, keyFrame, compositionTimeOffset, data):
+		if track.config is None:
+			return
+		if track.isVideo and track.needKeyFrame:
+			if not keyFrame:
+				return
+			track.needKeyFrame = False
+		if self._initSegmentNeeded:
+			self._initSegmentNeeded = False
+			initSegment = self.mp4f.makeInitSegment(self._video.config, self._audio.config)
+			if self.oninitsegment:
+				self.oninitsegment(self, initSegment)
+
+		if track.pending:
+			self._readySample(track, track.pending, max(0, dts - track.pending[0]))
+
+		if self._fragmentStart is not None:
+			if (self.fragmentOnKeyFrame and keyFrame and track.isVideo and track.samples) \
+			 or ((self.maxFragmentDuration > 0) and (dts - self._fragmentStart >= self.maxFragmentDuration * TIMESCALE)):
+				self._emitFragment()
+
+		track.pending = [dts, SAMPLE_FLAGS_SYNC if keyFrame else SAMPLE_FLAGS_NON_SYNC, compositionTimeOffset, data]
+
+	def _readySample(self, track, sample, duration):
+		dts, flags, compositionTimeOffset, data = sample
+		if not track.samples:
+			track.baseDecodeTime = dts
+			if (self._fragmentStart is None) or (dts < self._fragmentStart):
+				self._fragmentStart = dts
+		track.samples.append((duration, flags, compositionTimeOffset, data))
+		track.lastDuration = duration
+
+	def _emitFragment(self):
+		trafs = []
+		end = self._fragmentStart
+		for track in [self._video, self._audio]:
+			if track.samples:
+				trafs.append((track.trackID, track.baseDecodeTime, track.samples))
+				end = max(end, track.baseDecodeTime + sum(each[0] for each in track.samples))
+				track.samples = []
+		if not trafs:
+			return
+
+		start = self._fragmentStart
+		self._fragmentStart = None
+		fragment = self.mp4f.makeFragment(trafs)
+		if self.onfragment:
+			self.onfragment(self, fragment, start / float(TIMESCALE), (end - start) / float(TIMESCALE))
+
+
+# --- benchmark
+
+TEST_AVCC = bytes.fromhex("0142c01fffe100096742c01fda014016e401000468ce3c80") # 1280x720 baseline
+TEST_AAC_CONFIG = b"\x12\x10" # AAC-LC 44.1kHz stereo
+
+def makeTestStream(seconds, frameRate = 30.0, gop = 2.0, videoKbps = 2000, audioKbps = 128):
+	# answer a list of TC messages for seconds of synthetic AVC video and AAC audio
+	def _message(messageType, timestamp, header, size):
+		return bytes([messageType]) + U32.pack(int(timestamp) & 0xffffffff) + header + bytes(size)
+
+	messages = [
+		(0, _message(TCMSG_VIDEO, 0, bytes([TC_VIDEO_FRAMETYPE_IDR | TC_VIDEO_CODEC_AVC, TC_VIDEO_AVCPACKET_AVCC, 0, 0, 0]) + TEST_AVCC, 0)),
+		(0, _message(TCMSG_AUDIO, 0, bytes([TC_AUDIO_CODEC_AAC | 0x0f, TC_AUDIO_AACPACKET_AUDIO_SPECIFIC_CONFIG]) + TEST_AAC_CONFIG, 0))
+	]
+
+	framesPerGOP = max(1, int(frameRate * gop))
+	frameSize = int(videoKbps * 1000 / 8 / frameRate)
+	for frame in range(int(seconds * frameRate)):
+		timestamp = frame * 1000.0 / frameRate
+		keyFrame = 0 == frame % framesPerGOP
+		header = bytes([(TC_VIDEO_FRAMETYPE_IDR if keyFrame else 2 << 4) | TC_VIDEO_CODEC_AVC, TC_VIDEO_AVCPACKET_NALU, 0, 0, 0])
+		messages.append((timestamp, _message(TCMSG_VIDEO, timestamp, header, frameSize * 4 if keyFrame else frameSize)))
+
+	audioFrameRate = 44100 / 1024.0
+	audioFrameSize = int(audioKbps * 1000 / 8 / audioFrameRate)
+	for frame in range(int(seconds * audioFrameRate)):
+		timestamp = frame * 1000.0 / audioFrameRate
+		header = bytes([TC_AUDIO_CODEC_AAC | 0x0f, TC_AUDIO_AACPACKET_AUDIO_AAC])
+		messages.append((timestamp, _message(TCMSG_AUDIO, timestamp, header, audioFrameSize)))
+
+	messages.sort(key = lambda each: each[0])
+	return [each[1] for each in messages]
+
+def runBenchmark(numStreams, messages, seconds, out = sys.stdout):
+	# mux numStreams concurrent copies of messages, interleaved message by message
+	stats = { "fragments": 0, "bytes": 0 }
+	def _onfragment(muxer, data, startTime, duration):
+		stats["fragments"] += 1
+		stats["bytes"] += len(data)
+
+	muxers = []
+	for x in range(numStreams):
+		muxer = FragmentMuxer()
+		muxer.onfragment = _onfragment
+		muxers.append(muxer)
+
+	inputBytes = sum(len(each) for each in messages)
+	cpuStart = time.process_time()
+	wallStart = time.time()
+	for message in messages:
+		for muxer in muxers:
+			muxer.appendMessage(message)
+	for muxer in muxers:
+		muxer.flush()
+	cpu = time.process_time() - cpuStart
+	elapsed = time.time() - wallStart
+
+	numMessages = len(messages) * numStreams
+	out.write("%6d streams: %9.0f msg/s %8.1f MB/s %7.2fus cpu/msg %7d fragments  %6.0f realtime streams/core\n" % (
+		numStreams, numMessages / elapsed, inputBytes * numStreams / elapsed / 1000000.0,
+		cpu * 1000000.0 / numMessages, stats["fragments"], seconds * numStreams / cpu))
+
+def main(argv):
+	parser = argparse.ArgumentParser(description = "fragmented MP4 muxer throughput benchmark")
+	parser.add_argument("--streams", default = "1,10,100,1000",
+		help = "comma separated concurrent stream counts to step through (default 1,10,100,1000)")
+	parser.add_argument("--seconds", type = float, default = 10.0, help = "seconds of media per stream (default 10)")
+	parser.add_argument("--fps", type = float, default = 30.0, help = "video frame rate (default 30)")
+	parser.add_argument("--gop", type = float, default = 2.0, help = "seconds between keyframes (default 2)")
+	parser.add_argument("--video-kbps", type = float, default = 2000, help = "video bit rate (default 2000)")
+	parser.add_argument("--audio-kbps", type = float, default = 128, help = "audio bit rate (default 128)")
+	parser.add_argument("--time-slice", type = float, metavar = "SECONDS",
+		help = "cut fragments every SECONDS instead of per GOP")
+	args = parser.parse_args(argv)
+
+	if args.time_slice:
+		FragmentMuxer.fragmentOnKeyFrame = False
+		FragmentMuxer.maxFragmentDuration = args.time_slice
+
+	messages = makeTestStream(args.seconds, args.fps, args.gop, args.video_kbps, args.audio_kbps)
+	sys.stdout.write("%d messages, %.1f MB per stream\n" % (len(messages), sum(len(each) for each in messages) / 1000000.0))
+	for numStreams in [int(each) for each in args.streams.split(",")]:
+		runBenchmark(numStreams, messages, args.seconds)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
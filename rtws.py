@@ -2,8 +2,19 @@
 # SPDX-License-Identifier: MIT
 
 from collections import deque
+from functools import reduce
+import heapq
+import struct
+import sys
+import threading
 import time
 import traceback
+import zlib
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
 
 MSG_PING = 0x01
 MSG_PING_REPLY = 0x41
@@ -17,6 +28,8 @@ MSG_FLOW_CLOSE = 0x1c
 MSG_DATA_ACK = 0x5a
 MSG_FLOW_CLOSE_ACK = 0x5c
 MSG_FLOW_EXCEPTION = 0x5e
+MSG_FLOW_COMPRESSION = 0x12
+MSG_FLOW_COMPRESSION_ACK = 0x52
 
 PRI_LOWEST  = 0
 PRI_HIGHEST = 7
@@ -34,6 +47,10 @@ NUM_PRIORITIES = 8
 
 inf = float('infinity')
 
+# preset compression dictionaries by ID, registered with setCompressionDictionary()
+# on both ends before opening flows that use them.
+compressionDictionaries = {}
+
 
 class _RTTEntry:
 	def __init__(self, timestamp, rtt):
@@ -47,6 +64,12 @@ class IWebSocketAdapter(object):
 	def callLater(self, item):
 		pass
 
+	def callFromThread(self, item):
+		# like callLater, but must be safe to call from any thread (for example,
+		# Twisted's reactor.callFromThread). the default is only correct for
+		# adapters whose callLater is already thread-safe.
+		self.callLater(item)
+
 	def close(self):
 		pass
 
@@ -61,6 +84,13 @@ class RTWebSocket(object):
 	minOutstandingThresh = 64*1024
 	outstandingThresh = 64*1024
 	maxAdditionalDelay = 0.050
+	pingInterval = 15.0
+	pingTimeout = 45.0
+	scheduling = "priority" # or "deadline" (earliest deadline first within each priority), "deadline-global" (see _transmitByDeadline)
+	transmitTimeBudget = 0.005 # seconds per _transmit pass before yielding to the event loop
+	deliveryBudgetMessages = 64 # messages delivered to RecvFlows per turn before yielding
+	deliveryBudgetBytes = 1024*1024 # bytes delivered to RecvFlows per turn before yielding
+	maxDecompressedSize = 16*1024*1024 # a compressed message expanding past this closes its RecvFlow
 
 	sendFlowIDBatchSize = 16
 	sendFlowIDRefresh   = 4
@@ -87,13 +117,34 @@ class RTWebSocket(object):
 		self._rttMeasurements = deque([_RTTEntry(-inf, inf)])
 		self._baseRTTCache = 0.1
 		self._smoothedRTT = 0.1
+		self._bandwidth = inf
+		self._bandwidthTimestamp = -inf
+		self._lastRTTSample = self._lastReceive = time.time()
+		self._pingSentAt = None
+		self._pingForRTT = False
+		self._submissions = deque()
+		self._submissionWakePending = False
+		self._transmitYieldAt = inf
+		self._transmitYielded = False
+		self._deliveryScheduled = False
+		self._compressionOffer = None # (flowID, codec) from the message just received
 
 		self._transmissionWork = {}
-		for x in xrange(0, NUM_PRIORITIES):
+		self._deadlineWork = {}
+		self._deadlineSequence = 0
+		self._deliveryWork = {}
+		for x in range(0, NUM_PRIORITIES):
 			self._transmissionWork[x] = deque()
+			self._deadlineWork[x] = []
+			self._deliveryWork[x] = deque()
 
-	def openFlow(self, metadata, pri = PRI_ROUTINE):
-		return self._basicOpenFlow(metadata, pri, None)
+	def openFlow(self, metadata, pri = PRI_ROUTINE, compression = None, dictionaryID = None):
+		return self._basicOpenFlow(metadata, pri, None, compression, dictionaryID)
+
+	def callFromThread(self, callable_f, *p, **kw):
+		# thread-safe: call callable_f on the adapter's thread at the start of the
+		# next transmission pass, in submission order with SendFlow.submit().
+		self._submit(callable_f, p, kw)
 
 	def close(self):
 		if not self._isOpen:
@@ -116,6 +167,7 @@ class RTWebSocket(object):
 		self._recvFlowsByID = {}
 		self._ackFlows = set()
 		self._transmissionWork = {}
+		self._deadlineWork = {}
 
 	@property
 	def isOpen(self):
@@ -125,6 +177,10 @@ class RTWebSocket(object):
 	def bytesInflight(self):
 		return self._flowBytesSent - self._flowBytesAcked
 
+	@property
+	def bufferLength(self):
+		return sum(sendFlow.bufferLength for sendFlow in self._sendFlowsByID.values())
+
 	@property
 	def baseRTT(self):
 		return self._baseRTTCache
@@ -134,10 +190,10 @@ class RTWebSocket(object):
 		return self._smoothedRTT
 
 	def onrecvflow(self, recvFlow):
-		print "onrecvflow", recvFlow
+		print("onrecvflow", recvFlow)
 
 	def onclose(self, sender):
-		print "onclose", sender
+		print("onclose", sender)
 
 	# adapter interface
 
@@ -145,8 +201,15 @@ class RTWebSocket(object):
 		if len(message) < 1:
 			return
 
-		message = bytearray(message)
+		if not isinstance(message, bytes):
+			message = bytes(message)
+		message = memoryview(message)
 		code = message[0]
+		self._lastReceive = time.time()
+
+		# a compression offer only applies to the flow open immediately following it
+		offer = self._compressionOffer
+		self._compressionOffer = None
 
 		try:
 			if code in [MSG_DATA_LAST, MSG_DATA_MORE]:
@@ -154,7 +217,7 @@ class RTWebSocket(object):
 			elif MSG_DATA_ACK == code:
 				self._onDataAckMessage(message)
 			elif code in [MSG_FLOW_OPEN, MSG_FLOW_OPEN_RETURN]:
-				self._onFlowOpenMessage(message)
+				self._onFlowOpenMessage(message, offer)
 			elif MSG_ACK_WINDOW == code:
 				self._onAckWindowMessage(message)
 			elif MSG_DATA_ABANDON == code:
@@ -169,8 +232,12 @@ class RTWebSocket(object):
 				self._onPingMessage(message)
 			elif MSG_PING_REPLY == code:
 				self._onPingReplyMessage(message)
-		except Exception, e:
-			print "RTWebSocket protocol error", e
+			elif MSG_FLOW_COMPRESSION == code:
+				self._onFlowCompressionMessage(message)
+			elif MSG_FLOW_COMPRESSION_ACK == code:
+				self._onFlowCompressionAckMessage(message)
+		except Exception as e:
+			print("RTWebSocket protocol error", e)
 			traceback.print_exc()
 			self.close()
 
@@ -188,8 +255,9 @@ class RTWebSocket(object):
 		item()
 
 	def adapter_doPeriodicWork(self):
-		self._transmit()
 		self._sendAcks()
+		self._transmit()
+		self._checkPing()
 
 	# private methods
 
@@ -198,27 +266,26 @@ class RTWebSocket(object):
 			callable_f(*p, **kw)
 		self._adapter.callLater(_item)
 
-	def _basicOpenFlow(self, metadata, pri, returnFlowID):
+	def _basicOpenFlow(self, metadata, pri, returnFlowID, compression = None, dictionaryID = None):
 		if not self.isOpen:
 			raise IOError("not open")
+		codec = _FlowCodec(compression, dictionaryID) if compression else None
 		flowID = self._getNextFreeSendFlowID()
-		flow = SendFlow(self, flowID, returnFlowID, metadata)
+		flow = SendFlow(self, flowID, returnFlowID, metadata, codec)
 		self._sendFlowsByID[flowID] = flow
 		flow.priority = pri
 		return flow
 
 	def _getNextFreeSendFlowID(self):
 		if len(self._sendFlowFreeIDs) < self.sendFlowIDRefresh:
-			for x in xrange(0, self.sendFlowIDBatchSize):
+			for x in range(0, self.sendFlowIDBatchSize):
 				self._sendFlowFreeIDs.append(self._nextSendFlowID)
 				self._nextSendFlowID += 1
 		return self._sendFlowFreeIDs.popleft()
 
 	def _sendBytes(self, message):
 		if self._isOpen:
-			if type(message) == list:
-				message = bytearray(message)
-			if type(message) == bytearray:
+			if type(message) != bytes:
 				message = bytes(message)
 			self._adapter.send(message)
 			self._sentBytesAccumulator += len(message)
@@ -226,46 +293,161 @@ class RTWebSocket(object):
 	def _queueTransmission(self, sendFlow):
 		if not self._isOpen:
 			return
-		flows = self._transmissionWork[sendFlow.priority]
-		if sendFlow not in flows:
-			flows.append(sendFlow)
+		if self._isDeadlineScheduling():
+			self._queueDeadlineTransmission(sendFlow, sendFlow.priority)
+		else:
+			flows = self._transmissionWork[sendFlow.priority]
+			if sendFlow not in flows:
+				flows.append(sendFlow)
 		self._scheduleTransmission()
 
+	def _isDeadlineScheduling(self):
+		return self.scheduling in ["deadline", "deadline-global"]
+
+	def _queueDeadlineTransmission(self, sendFlow, pri):
+		# each priority band is a heap of [deadline, sequence, sendFlow, pri] entries.
+		# a flow has at most one live entry; requeueing it with a new deadline or
+		# priority invalidates the old entry, which is discarded when it surfaces.
+		deadline = sendFlow._nextDeadline()
+		entry = sendFlow._deadlineEntry
+		if entry is not None:
+			if (entry[0] == deadline) and (entry[3] == pri):
+				return
+			entry[2] = None
+		self._deadlineSequence += 1
+		entry = [deadline, self._deadlineSequence, sendFlow, pri]
+		sendFlow._deadlineEntry = entry
+		heapq.heappush(self._deadlineWork[pri], entry)
+
+	def _migrateTransmissionWork(self, toDeadline):
+		# move queued flows between the round-robin and deadline structures if
+		# scheduling was changed while flows were queued.
+		for pri in range(PRI_LOWEST, PRI_HIGHEST + 1):
+			if toDeadline:
+				flows = self._transmissionWork[pri]
+				while len(flows):
+					self._queueDeadlineTransmission(flows.popleft(), pri)
+			else:
+				heap = self._deadlineWork[pri]
+				for entry in heap:
+					if entry[2] is not None:
+						entry[2]._deadlineEntry = None
+						self._transmissionWork[pri].append(entry[2])
+				del heap[:]
+
 	def _scheduleTransmission(self):
 		if self._sendNow:
 			return
 		self._callLater(self._transmit)
 		self._sendNow = True
 
+	def _submit(self, callable_f, p, kw):
+		self._submissions.append((callable_f, p, kw))
+		if not self._submissionWakePending:
+			self._submissionWakePending = True
+			self._adapter.callFromThread(self._transmit)
+
+	def _drainSubmissions(self):
+		# clear the wake flag before draining so a submission racing with the drain
+		# either gets drained here or schedules another wakeup.
+		self._submissionWakePending = False
+		submissions = self._submissions
+		while len(submissions):
+			callable_f, p, kw = submissions.popleft()
+			try:
+				callable_f(*p, **kw)
+			except Exception as e:
+				print("exception calling submitted function", e)
+				traceback.print_exc()
+
 	def _transmit(self):
+		self._drainSubmissions()
 		if not self._isOpen:
 			return
 		self._sendNow = False
+
+		# control lane: pending acks (and flow close acks) go out ahead of any data
+		# fragments queued in this pass.
+		self._sendAcks()
+
 		self._sentBytesAccumulator = 0
+		self._transmitYieldAt = time.time() + self.transmitTimeBudget
+		self._transmitYielded = False
+		if self._isDeadlineScheduling():
+			self._migrateTransmissionWork(True)
+			self._transmitByDeadline("deadline-global" == self.scheduling)
+		else:
+			self._migrateTransmissionWork(False)
+			self._transmitByPriority()
+		self._startRTT()
+
+		# out of time with work still to do: let other connections on this event
+		# loop run, then continue.
+		if self._transmitYielded:
+			self._scheduleTransmission()
+
+	def _transmitLimited(self):
+		if self._isPaused or (not self._isOpen) \
+		  or (self._sentBytesAccumulator >= self.sendThresh) \
+		  or (self.bytesInflight >= self.outstandingThresh):
+			return True
+		if (self._sentBytesAccumulator > 0) and (time.time() >= self._transmitYieldAt):
+			self._transmitYielded = True
+			return True
+		return False
+
+	def _transmitByPriority(self):
 		pri = PRI_HIGHEST
 		while pri >= PRI_LOWEST:
 			flows = self._transmissionWork[pri]
 			while len(flows) > 0:
-				if self._isPaused or (not self._isOpen) \
-				  or (self._sentBytesAccumulator >= self.sendThresh) \
-				  or (self.bytesInflight >= self.outstandingThresh):
-					pri = -inf
-					break
+				if self._transmitLimited():
+					return
 				sendFlow = flows.popleft()
 				if sendFlow._transmit(pri):
 					flows.append(sendFlow)
 			pri -= 1
-		self._startRTT()
+
+	def _transmitByDeadline(self, acrossPriorities):
+		# each pass takes the earliest deadline at the head of each priority band's heap.
+		# within a band, equal deadlines (including none) are served round-robin. without
+		# acrossPriorities, the highest band with work wins. with it, the earliest deadline
+		# across bands wins, except that a band whose earliest work has no deadline is
+		# ordered by priority: it goes after earlier deadlines in higher bands and ahead
+		# of everything in lower bands.
+		work = self._deadlineWork
+		while not self._transmitLimited():
+			bestPri = None
+			bestDeadline = inf
+			for pri in range(PRI_HIGHEST, PRI_LOWEST - 1, -1):
+				heap = work[pri]
+				while len(heap) and (heap[0][2] is None):
+					heapq.heappop(heap)
+				if 0 == len(heap):
+					continue
+				deadline = heap[0][0]
+				if (bestPri is None) or (deadline < bestDeadline):
+					bestPri, bestDeadline = pri, deadline
+				if (not acrossPriorities) or (deadline == inf):
+					break
+			if bestPri is None:
+				break
+
+			entry = heapq.heappop(work[bestPri])
+			sendFlow = entry[2]
+			sendFlow._deadlineEntry = None
+			if sendFlow._transmit(bestPri):
+				self._queueDeadlineTransmission(sendFlow, bestPri)
 
 	def _startRTT(self):
 		if (self._rttAnchor is None) and (self._flowBytesSent > self._rttPreviousPosition):
 			self._rttAnchor = time.time()
 			self._rttPosition = self._flowBytesSent
 
-			ackWin = max(self.minAckWindow, (self._flowBytesSent - self._flowBytesAcked) / 4)
-			ackWin = long(min(ackWin, self.sendThresh / 2))
+			ackWin = max(self.minAckWindow, (self._flowBytesSent - self._flowBytesAcked) // 4)
+			ackWin = int(min(ackWin, self.sendThresh // 2))
 
-			self._sendBytes(chr(MSG_ACK_WINDOW) + makeVLU(ackWin))
+			self._sendBytes(bytes([MSG_ACK_WINDOW]) + makeVLU(ackWin))
 
 	def _measureRTT(self):
 		if (self._rttAnchor is not None) and (self._flowBytesAcked >= self._rttPosition):
@@ -276,10 +458,13 @@ class RTWebSocket(object):
 			self._rttAnchor = None
 			self._rttPreviousPosition = self._flowBytesSent
 			self._smoothedRTT = ((self._smoothedRTT * 7.0) + rtt) / 8.0
+			self._lastRTTSample = now
 
 			self._addRTT(now, rtt)
 
 			if numBytes >= self.outstandingThresh - self.minAckWindow:
+				self._bandwidth = bandwidth
+				self._bandwidthTimestamp = now
 				self.outstandingThresh = max(self.minOutstandingThresh,
 					bandwidth * (self.baseRTT + self.maxAdditionalDelay))
 
@@ -317,25 +502,112 @@ class RTWebSocket(object):
 		while len(self._ackFlows):
 			self._ackFlows.pop()._sendAck()
 
+	def _queueDelivery(self, recvFlow):
+		flows = self._deliveryWork[recvFlow.priority]
+		if recvFlow not in flows:
+			flows.append(recvFlow)
+		self._scheduleDelivery()
+
+	def _scheduleDelivery(self):
+		if self._deliveryScheduled:
+			return
+		self._callLater(self._deliver)
+		self._deliveryScheduled = True
+
+	def _deliver(self):
+		# deliver ready messages across all RecvFlows, highest receiver priority first and
+		# round-robin within a priority, until this turn's budget is used. then yield to the
+		# event loop so a busy consumer still sees newly arrived urgent messages first.
+		self._deliveryScheduled = False
+		numMessages = 0
+		numBytes = 0
+		pri = PRI_HIGHEST
+		while pri >= PRI_LOWEST:
+			flows = self._deliveryWork[pri]
+			while len(flows) > 0:
+				if (numMessages >= self.deliveryBudgetMessages) or (numBytes >= self.deliveryBudgetBytes):
+					self._scheduleDelivery()
+					return
+				recvFlow = flows.popleft()
+				if recvFlow.priority != pri:
+					continue
+				length = recvFlow._deliverData()
+				if length is not None:
+					numMessages += 1
+					numBytes += length
+					flows.append(recvFlow)
+			pri -= 1
+
 	def _sendPing(self):
-		self._sendBytes(chr(MSG_PING) + "ping!")
+		self._pingSentAt = time.time()
+		self._sendBytes(bytes([MSG_PING]) + struct.pack("!d", self._pingSentAt))
+
+	def _isApplicationLimited(self):
+		if (self._rttAnchor is not None) or self._isPaused:
+			return False
+		for flows in self._transmissionWork.values():
+			if len(flows):
+				return False
+		for heap in self._deadlineWork.values():
+			for entry in heap:
+				if entry[2] is not None:
+					return False
+		return True
+
+	def _congestedBandwidth(self):
+		# answer the estimated bandwidth if the connection is congested (enough in flight
+		# that more data will queue behind it), otherwise inf. the estimate comes only from
+		# window-limited RTT samples, so it expires like an RTT history entry.
+		if time.time() - self._bandwidthTimestamp > self.rttHistoryThresh:
+			self._bandwidth = inf
+		if self.bytesInflight < self.outstandingThresh // 2:
+			return inf
+		return self._bandwidth
+
+	def _checkPing(self):
+		if (not self._isOpen) or (self.pingInterval <= 0):
+			return
+		now = time.time()
+		if self._pingSentAt is not None:
+			if now - self._pingSentAt > self.pingTimeout:
+				print("RTWebSocket ping timeout")
+				self.close()
+			return
+
+		# probe when the RTT estimate has gone stale while idle or application-limited,
+		# and as a keepalive when nothing has been heard from the far end for a while.
+		appLimited = self._isApplicationLimited()
+		if (appLimited and (now - self._lastRTTSample >= self.pingInterval)) \
+		  or (now - self._lastReceive >= self.pingInterval):
+			self._pingForRTT = appLimited
+			self._sendPing()
 
 	# packet handlers
 
 	def _onPingMessage(self, message):
-		print "_onPingMessage"
-		message[0] = MSG_PING_REPLY
-		self._sendBytes(message)
+		self._sendBytes(bytes([MSG_PING_REPLY]) + message[1:])
 
 	def _onPingReplyMessage(self, message):
-		print "_onPingReply", message[1:]
+		if (self._pingSentAt is None) or (len(message) != 9):
+			return
+		sentAt = struct.unpack("!d", message[1:])[0]
+		if sentAt != self._pingSentAt:
+			return
+		self._pingSentAt = None
+
+		if self._pingForRTT:
+			now = time.time()
+			rtt = max(now - sentAt, 0.0001)
+			self._smoothedRTT = ((self._smoothedRTT * 7.0) + rtt) / 8.0
+			self._lastRTTSample = now
+			self._addRTT(now, rtt)
 
 	def _onAckWindowMessage(self, message):
 		cursor, ackWindow = parseVLU(message, 1)
 		self._ackWindow = max(ackWindow, self.minAckWindow)
 		self._recvAccumulator = 0
 
-	def _onFlowOpenMessage(self, message):
+	def _onFlowOpenMessage(self, message, offer = None):
 		hasReturnAssociation = (MSG_FLOW_OPEN_RETURN == message[0])
 		returnAssociation = None
 
@@ -343,12 +615,18 @@ class RTWebSocket(object):
 		if hasReturnAssociation:
 			cursor, returnAssociationID = parseVLU(message, cursor)
 			returnAssociation = self._sendFlowsByID.get(returnAssociationID, None)
-		metadata = message[cursor:]
+		metadata = bytearray(message[cursor:])
 
 		if self._recvFlowsByID.get(flowID, None) is not None:
-			raise ValueError("RecvFlow open: flowID " + flowID + " already in use")
+			raise ValueError("RecvFlow open: flowID " + str(flowID) + " already in use")
+
+		# an offer for this flow is the message immediately before its open. accepting it
+		# here goes out before the flow's first ack, which the sender waits for.
+		codec = offer[1] if (offer is not None) and (offer[0] == flowID) else None
+		if codec is not None:
+			self._sendBytes(bytes([MSG_FLOW_COMPRESSION_ACK]) + makeVLU(flowID))
 
-		recvFlow = RecvFlow(self, flowID, metadata, returnAssociation)
+		recvFlow = RecvFlow(self, flowID, metadata, returnAssociation, codec)
 		self._recvFlowsByID[flowID] = recvFlow
 
 		if hasReturnAssociation and (returnAssociation is None):
@@ -360,8 +638,8 @@ class RTWebSocket(object):
 				returnAssociation.onrecvflow(recvFlow)
 			else:
 				self.onrecvflow(recvFlow)
-		except Exception, e:
-			print "exception while notifying new RecvFlow", e
+		except Exception as e:
+			print("exception while notifying new RecvFlow", e)
 			traceback.print_exc()
 
 		if not recvFlow.isOpen:
@@ -369,6 +647,20 @@ class RTWebSocket(object):
 
 		recvFlow._queueAck(True)
 
+	def _onFlowCompressionMessage(self, message):
+		cursor, flowID = parseVLU(message, 1)
+		fields = bytes(message[cursor:]).split(b"\x00")
+		if len(fields) != 2:
+			raise ValueError("invalid flow compression offer")
+		try:
+			self._compressionOffer = (flowID, _FlowCodec(fields[0].decode("utf-8"), fields[1].decode("utf-8") or None))
+		except ValueError as e:
+			print("RTWebSocket declining compression", e)
+
+	def _onFlowCompressionAckMessage(self, message):
+		cursor, flowID = parseVLU(message, 1)
+		self._sendFlowsByID[flowID]._onCompressionAccepted()
+
 	def _onDataMessage(self, message):
 		more = (MSG_DATA_MORE == message[0])
 
@@ -418,16 +710,17 @@ class RTWebSocket(object):
 		if cursor < len(message):
 			cursor, reasonCode = parseVLU(message, cursor)
 			if cursor < len(message):
-				description = message[cursor:].decode("utf-8")
+				description = str(message[cursor:], "utf-8")
 		self._sendFlowsByID[flowID]._onExceptionMessage(reasonCode, description)
 
 
 class SendFlow(object):
 	def __repr__(self):
-		return "<SendFlow id:" + `self._flowID` + " @" + hex(id(self)) + ">"
+		return "<SendFlow id:" + repr(self._flowID) + " @" + hex(id(self)) + ">"
 
-	def __init__(self, owner, flowID, returnFlowID, metadata):
+	def __init__(self, owner, flowID, returnFlowID, metadata, codec = None):
 		self._owner = owner
+		self._codec = codec
 		self._flowID = flowID
 		self._priority = PRI_ROUTINE
 		self._sendBuffer = deque()
@@ -440,28 +733,39 @@ class SendFlow(object):
 		self._shouldNotifyWhenWritable = False
 		self._ackedPosition = 0
 		self._nextMessageNumber = 1
+		self._conflate = False
+		self._conflationSlots = {}
+		self._deadlineEntry = None
 
-		metadata = metadata or ""
-		if type(metadata) == unicode:
+		metadata = metadata or b""
+		if type(metadata) == str:
 			metadata = metadata.encode("utf-8")
-
-		self._flowOpenMessage = bytearray().join([
-			chr(MSG_FLOW_OPEN_RETURN) if returnFlowID >= 0 else chr(MSG_FLOW_OPEN),
+		elif type(metadata) != bytes:
+			metadata = bytes(metadata)
+
+		# data is held until the receiver accepts or ignores the compression offer
+		self._compressionOffered = codec is not None
+		self._compressionOfferMessage = None
+		if codec is not None:
+			dictionaryID = codec.dictionaryID if codec.dictionaryID is not None else ""
+			self._compressionOfferMessage = b"".join([bytes([MSG_FLOW_COMPRESSION]), makeVLU(flowID),
+				codec.compression.encode("utf-8"), b"\x00", dictionaryID.encode("utf-8")])
+
+		hasReturnFlowID = (returnFlowID is not None) and (returnFlowID >= 0)
+		self._flowOpenMessage = b"".join([
+			bytes([MSG_FLOW_OPEN_RETURN if hasReturnFlowID else MSG_FLOW_OPEN]),
 			makeVLU(flowID),
-			makeVLU(returnFlowID) if returnFlowID >= 0 else bytearray(),
+			makeVLU(returnFlowID) if hasReturnFlowID else b"",
 			metadata
 		])
 
-		self._flowCloseMessage = bytearray().join([chr(MSG_FLOW_CLOSE), makeVLU(flowID)])
+		self._flowCloseMessage = bytes([MSG_FLOW_CLOSE]) + makeVLU(flowID)
+		self._dataLastHeader = bytes([MSG_DATA_LAST]) + makeVLU(flowID)
+		self._dataMoreHeader = bytes([MSG_DATA_MORE]) + makeVLU(flowID)
 
-	def write(self, data, startBy = inf, endBy = inf):
-		if type(data) != str:
-			if type(data) == unicode:
-				data = data.encode('utf-8')
-			if type(data) == list:
-				data = bytearray(data)
-			if type(data) == bytearray:
-				data = bytes(data)
+	def write(self, data, startBy = inf, endBy = inf, key = None):
+		raw = self._prepareData(data)
+		data = self._codec.encode(raw) if self._codec is not None else raw
 
 		if not self._open:
 			raise IOError("write: flow is closed")
@@ -470,13 +774,67 @@ class SendFlow(object):
 		receipt.startBy = startBy
 		receipt.endBy = endBy
 
-		message = self.WriteMessage(data, receipt)
+		self._enqueue(data, receipt, key, raw)
+		return receipt
+
+	def submit(self, data, startBy = inf, endBy = inf, key = None):
+		# thread-safe write for producers not on the adapter's thread. data is converted
+		# (and compressed) on the calling thread; the message is queued at the start of
+		# the next transmission pass. answer a WriteReceipt immediately. its messageNumber
+		# is assigned when the message is queued, and it is abandoned if this flow is
+		# closed by then. its callbacks are called on the adapter's thread.
+		codec = self._codec
+		raw = self._prepareData(data)
+		data = codec.encode(raw) if codec is not None else raw
+		receipt = WriteReceipt(self._owner._callLater, None)
+		receipt.startBy = startBy
+		receipt.endBy = endBy
+		self._owner._submit(self._onSubmitted, (data, raw, receipt, key, codec), {})
+		return receipt
+
+	def _prepareData(self, data):
+		if type(data) != bytes and not isinstance(data, SharedMessage):
+			if type(data) == str:
+				data = data.encode('utf-8')
+			else:
+				data = bytes(data)
+		return data
+
+	def _onSubmitted(self, data, raw, receipt, key, codec = None):
+		if not self._open:
+			receipt.abandon()
+			return
+		if (codec is not None) and (self._codec is None):
+			data = raw # compression was declined after this was encoded
+		receipt._messageNumber = self._nextMessageNumber
+		self._enqueue(data, receipt, key, raw)
+
+	def _enqueue(self, data, receipt, key = None, raw = None):
+		# raw, the data before compression, is kept only while the compression offer is
+		# pending, to fall back to if it's declined
+		raw = raw if self._compressionOffered else None
+		if self._conflate:
+			message = self._conflationSlots.get(key, None)
+			if (message is not None) and not (message.receipt.started or message.receipt.abandoned):
+				# replace the queued message in place. the new message takes its place
+				# in the queue and its message number, and the old one is abandoned.
+				oldReceipt = message.receipt
+				receipt._messageNumber = oldReceipt.messageNumber
+				self._sendBufferByteLength += len(data) - len(message.data)
+				message.setData(data, raw)
+				message.receipt = receipt
+				oldReceipt.abandon()
+				self._queueTransmission()
+				return
+
+		message = self.WriteMessage(data, receipt, key, raw)
 		self._sendBuffer.append(message)
 		self._sendBufferByteLength += len(data)
 		self._nextMessageNumber += 1
+		if self._conflate:
+			self._conflationSlots[key] = message
 
 		self._queueTransmission()
-		return receipt
 
 	def close(self):
 		if not self._open:
@@ -485,11 +843,12 @@ class SendFlow(object):
 		self._queueTransmission()
 
 	def abandonQueuedMessages(self, age = 0, onlyUnstarted = False):
+		# the queue is oldest first, unless conflation replaced a message in place
 		for message in self._sendBuffer:
 			if message.receipt.age >= age:
 				if (not onlyUnstarted) or (not message.receipt.started):
 					message.receipt.abandon()
-			else:
+			elif not self._conflate:
 				break
 		self._queueTransmission()
 
@@ -502,6 +861,16 @@ class SendFlow(object):
 		self._priority = val
 		self._queueTransmission()
 
+	@property
+	def conflate(self):
+		return self._conflate
+	@conflate.setter
+	def conflate(self, val):
+		# if true, a write replaces the queued, unstarted message written with the
+		# same key (default None), so only the latest value per key is queued.
+		self._conflate = bool(val)
+		self._conflationSlots = {}
+
 	@property
 	def sndbuf(self):
 		return self._sndbuf
@@ -526,12 +895,16 @@ class SendFlow(object):
 	def isOpen(self):
 		return self._open
 
+	@property
+	def compression(self):
+		return self._codec.compression if self._codec else None
+
 	@property
 	def unsentAge(self):
-		for message in self._sendBuffer:
-			if not message.receipt.abandoned:
-				return message.receipt.age
-		return 0
+		ages = (message.receipt.age for message in self._sendBuffer if not message.receipt.abandoned)
+		if self._conflate:
+			return max(ages, default = 0)
+		return next(ages, 0)
 
 	def notifyWhenWritable(self):
 		self._shouldNotifyWhenWritable = True
@@ -541,10 +914,10 @@ class SendFlow(object):
 		return False
 
 	def onexception(self, sendFlow, code, description):
-		print "onexception", code, description
+		print("onexception", code, description)
 
 	def onrecvflow(self, recvFlow):
-		print "onrecvflow", recvFlow
+		print("onrecvflow", recvFlow)
 
 	def _queueWritableNotify(self):
 		if self._shouldNotifyWhenWritable and not self._writablePending:
@@ -560,25 +933,31 @@ class SendFlow(object):
 			self._shouldNotifyWhenWritable = False
 			try:
 				self._shouldNotifyWhenWritable = bool(self.onwritable(self))
-			except Exception, e:
+			except Exception as e:
 				traceback.print_exc()
-				print "exception calling SendFlow.onwritable", e
+				print("exception calling SendFlow.onwritable", e)
 
 	def _transmit(self, priority):
 		if priority != self.priority:
 			return False
 
 		if self._flowOpenMessage is not None:
+			if self._compressionOfferMessage is not None:
+				self._owner._sendBytes(self._compressionOfferMessage)
+				self._compressionOfferMessage = None
 			self._owner._sendBytes(self._flowOpenMessage)
 			self._flowOpenMessage = None
 			return True
 
+		if self._owner._isDeadlineScheduling():
+			self._shedLateMessages()
+
 		abandonCount = self._trimSendBuffer()
 		if abandonCount:
-			abandonMessage = bytearray().join([
-				chr(MSG_DATA_ABANDON),
+			abandonMessage = b"".join([
+				bytes([MSG_DATA_ABANDON]),
 				makeVLU(self._flowID),
-				makeVLU(abandonCount - 1) if abandonCount > 1 else b''
+				makeVLU(abandonCount - 1) if abandonCount > 1 else b""
 			])
 			self._owner._sendBytes(abandonMessage)
 			self._queueWritableNotify()
@@ -589,11 +968,40 @@ class SendFlow(object):
 			self._flowCloseMessage = None
 			return True
 
-		if self._sentByteCount >= self._sendThroughAllowed:
+		if self._compressionOffered or (self._sentByteCount >= self._sendThroughAllowed):
 			return False
 
 		return self._transmitOneFragment()
 
+	def _nextDeadline(self):
+		if self._flowOpenMessage is not None:
+			return -inf
+		for message in self._sendBuffer:
+			if message.receipt.abandoned:
+				return -inf
+			if self._conflate:
+				# a replaced message can be behind later deadlines, which wait for it
+				return min(each.receipt._deadline() for each in self._sendBuffer if not each.receipt.abandoned)
+			return message.receipt._deadline()
+		if (not self._open) and (self._flowCloseMessage is not None):
+			return -inf
+		return inf
+
+	def _shedLateMessages(self):
+		# under congestion, abandon unstarted messages at the head of the queue that can't
+		# be completely sent by their endBy deadline at the currently estimated bandwidth.
+		bandwidth = self._owner._congestedBandwidth()
+		if bandwidth == inf:
+			return
+		now = time.time()
+		for message in self._sendBuffer:
+			receipt = message.receipt
+			if receipt.abandoned:
+				continue
+			if receipt.started or (now + len(message.data) / bandwidth <= receipt._origin + receipt.endBy):
+				break
+			receipt.abandon()
+
 	def _trimSendBuffer(self):
 		abandonCount = 0
 		while len(self._sendBuffer):
@@ -603,10 +1011,15 @@ class SendFlow(object):
 				abandonCount += 1
 				self._sendBufferByteLength -= len(message.data)
 				self._sendBuffer.popleft()
+				self._dropConflationSlot(message)
 			else:
 				break
 		return abandonCount
 
+	def _dropConflationSlot(self, message):
+		if self._conflationSlots.get(message.key, None) is message:
+			del self._conflationSlots[message.key]
+
 	def _transmitOneFragment(self):
 		message = self._sendBuffer[0] if len(self._sendBuffer) else None
 		if (message is None) or message.receipt.abandoned:
@@ -618,14 +1031,16 @@ class SendFlow(object):
 
 		offsetFrom = message.offset
 		offsetTo = min(offsetFrom + chunkSize, len(message.data))
-		fragment = message.data[offsetFrom:offsetTo]
+		if isinstance(message.data, SharedMessage):
+			# don't cross a shared fragment boundary, so after a short fragment (from the
+			# flow control window or a different chunkSize) the rest realign and are sent
+			# without joining pieces of two fragments
+			sharedChunkSize = message.data.chunkSize
+			offsetTo = min(offsetTo, (offsetFrom // sharedChunkSize + 1) * sharedChunkSize)
+		fragment = message.view[offsetFrom:offsetTo]
 		isLast = (offsetTo == len(message.data))
-		
-		fragmentMessage = bytearray().join([
-			chr(MSG_DATA_LAST if isLast else MSG_DATA_MORE),
-			makeVLU(self._flowID),
-			fragment
-		])
+
+		fragmentMessage = (self._dataLastHeader if isLast else self._dataMoreHeader) + fragment
 
 		self._owner._sendBytes(fragmentMessage)
 		self._sentByteCount += len(fragmentMessage)
@@ -637,11 +1052,30 @@ class SendFlow(object):
 			message.receipt._onSent()
 			self._sendBuffer.popleft()
 			self._sendBufferByteLength -= len(message.data)
+			self._dropConflationSlot(message)
 			self._queueWritableNotify()
 
 		return True
 
+	def _onCompressionAccepted(self):
+		self._compressionOffered = False
+		for message in self._sendBuffer:
+			message.raw = None
+		self._queueTransmission()
+
+	def _declineCompression(self):
+		# the first ack arrived without the offer being accepted: the receiver doesn't
+		# support compression (or this codec). send everything uncompressed.
+		self._codec = None
+		self._compressionOffered = False
+		self._sendBufferByteLength = 0
+		for message in self._sendBuffer:
+			message.setData(message.raw)
+			self._sendBufferByteLength += len(message.data)
+
 	def _onAck(self, deltaBytes, bufferAdvertisement):
+		if self._compressionOffered:
+			self._declineCompression()
 		self._owner._flowBytesAcked += deltaBytes
 		self._ackedPosition += deltaBytes
 		self._rcvbuf = bufferAdvertisement
@@ -655,26 +1089,35 @@ class SendFlow(object):
 		self.abandonQueuedMessages(-inf)
 		try:
 			self.onexception(self, code, description)
-		except Exception, e:
-			print "error sending SendFlow.onexception", e
+		except Exception as e:
+			print("error sending SendFlow.onexception", e)
 			traceback.print_exc()
 		self._queueTransmission()
 
 	class WriteMessage(object):
-		def __init__(self, data, receipt):
-			self.data = data
+		def __init__(self, data, receipt, key = None, raw = None):
+			self.setData(data, raw)
 			self.receipt = receipt
+			self.key = key # conflation key
 			self.offset = 0
 
+		def setData(self, data, raw = None):
+			self.data = data
+			self.raw = raw
+			# fragments of bytes are sliced from a memoryview, so each is copied only
+			# once, into its fragment message
+			self.view = memoryview(data) if type(data) == bytes else data
+
 
 class RecvFlow(object):
 	def __repr__(self):
-		return "<RecvFlow id:" + `self._flowID` + " @" + hex(id(self)) + " b" + repr(bytes(self.metadata)) + ">"
+		return "<RecvFlow id:" + repr(self._flowID) + " @" + hex(id(self)) + " " + repr(bytes(self.metadata)) + ">"
 
-	def __init__(self, owner, flowID, metadata, returnAssociation):
+	def __init__(self, owner, flowID, metadata, returnAssociation, codec = None):
 		self._owner = owner
 		self._flowID = flowID
 		self._metadata = metadata
+		self._codec = codec
 		self._associatedSendFlow = returnAssociation
 		self._userOpen = False
 		self._open = True
@@ -687,7 +1130,7 @@ class RecvFlow(object):
 		self._sentComplete = False
 		self._sentCloseAck = False
 		self._nextMessageNumber = 1
-		self._deliveryPending = False
+		self._priority = PRI_ROUTINE
 		self._mode = "binary"
 		self._rcvbuf = owner.defaultRcvbuf
 
@@ -695,10 +1138,10 @@ class RecvFlow(object):
 		if self._open:
 			self._userOpen = True
 
-	def openReturnFlow(self, metadata, pri = PRI_ROUTINE):
+	def openReturnFlow(self, metadata, pri = PRI_ROUTINE, compression = None, dictionaryID = None):
 		if (not self.isOpen) or self._complete:
 			return
-		return self._owner._basicOpenFlow(metadata, pri, self._flowID)
+		return self._owner._basicOpenFlow(metadata, pri, self._flowID, compression, dictionaryID)
 
 	def close(self, code = None, description = None):
 		if not self._open:
@@ -711,12 +1154,12 @@ class RecvFlow(object):
 		if self._complete:
 			return
 
-		message = chr(MSG_FLOW_EXCEPTION) + makeVLU(self._flowID)
-		if code >= 0:
+		message = bytes([MSG_FLOW_EXCEPTION]) + makeVLU(self._flowID)
+		if (code is not None) and (code >= 0):
 			message += makeVLU(code)
-			if type(description) == str:
+			if type(description) == bytes:
 				message += description
-			elif type(description) == unicode:
+			elif type(description) == str:
 				message += description.encode('utf-8')
 		self._owner._sendBytes(message)
 
@@ -729,12 +1172,16 @@ class RecvFlow(object):
 		try:
 			return self._metadata.decode("utf-8")
 		except UnicodeError:
-			return u""
+			return ""
 
 	@property
 	def isOpen(self):
 		return self._open and self._userOpen
 
+	@property
+	def compression(self):
+		return self._codec.compression if self._codec else None
+
 	@property
 	def rcvbuf(self):
 		return self._rcvbuf
@@ -760,7 +1207,7 @@ class RecvFlow(object):
 		wasPaused = self._paused
 		self._paused = bool(val)
 		if not self._paused:
-			self._queueDelivery
+			self._queueDelivery()
 			if wasPaused:
 				self._queueAck(True)
 
@@ -768,6 +1215,17 @@ class RecvFlow(object):
 	def associatedSendFlow(self):
 		return self._associatedSendFlow
 
+	@property
+	def priority(self):
+		return self._priority
+	@priority.setter
+	def priority(self, val):
+		# the receiver's delivery priority for this flow, independent of the sender's.
+		# messages ready on higher priority flows are delivered first.
+		val = max(PRI_LOWEST, min(PRI_HIGHEST, int(val)))
+		self._priority = val
+		self._queueDelivery()
+
 	@property
 	def mode(self):
 		return self._mode
@@ -776,10 +1234,10 @@ class RecvFlow(object):
 		self._mode = val if val in ["binary", "text", "unicode"] else "binary"
 
 	def onmessage(self, recvFlow, message, number):
-		print "onmessage", recvFlow, "#", number
+		print("onmessage", recvFlow, "#", number)
 
 	def oncomplete(self, recvFlow):
-		print "oncomplete", recvFlow
+		print("oncomplete", recvFlow)
 
 	def _queueAck(self, immediate = False):
 		self._owner._queueAck(self, immediate)
@@ -789,16 +1247,16 @@ class RecvFlow(object):
 			return
 
 		advertisement = self.advertisement
-		self._ackThresh = advertisement / 2
+		self._ackThresh = advertisement // 2
 
-		message = chr(MSG_DATA_ACK) + makeVLU(self._flowID) + \
+		message = bytes([MSG_DATA_ACK]) + makeVLU(self._flowID) + \
 			makeVLU(self._receivedByteCount) + makeVLU(advertisement)
 		self._owner._sendBytes(message)
 
 		self._receivedByteCount = 0
 
 		if self._complete:
-			self._owner._sendBytes(chr(MSG_FLOW_CLOSE_ACK) + makeVLU(self._flowID))
+			self._owner._sendBytes(bytes([MSG_FLOW_CLOSE_ACK]) + makeVLU(self._flowID))
 			self._sentCloseAck = True
 
 	def _onFlowCloseMessage(self):
@@ -834,42 +1292,49 @@ class RecvFlow(object):
 		self._queueAck(True)
 
 	def _queueDelivery(self):
-		if (not self._deliveryPending) and (not self.paused):
-			self._owner._callLater(self._deliverData)
-			self._deliveryPending = True
+		if not self.paused:
+			self._owner._queueDelivery(self)
 
 	def _deliverData(self):
-		self._deliveryPending = False
-		while len(self._receiveBuffer):
-			if self.paused or not self.isOpen:
-				break
+		# deliver the next complete message. answer its length, or None if there
+		# was nothing to deliver.
+		if len(self._receiveBuffer) and not (self.paused or not self.isOpen):
 			message = self._receiveBuffer[0]
-			if not message.complete:
-				break
-
-			self._receiveBuffer.popleft()
-			self._receiveBufferByteLength -= message.totalLength
+			if message.complete:
+				self._receiveBuffer.popleft()
+				self._receiveBufferByteLength -= message.totalLength
+
+				fullMessage = message.getFullMessage()
+				if self._codec is not None:
+					try:
+						fullMessage = self._codec.decode(fullMessage, self._owner.maxDecompressedSize)
+					except Exception as e:
+						print("exception decompressing RecvFlow message", e)
+						self.close(0, "decompression error: " + str(e))
+						return None
+				if "binary" != self._mode:
+					fullMessage = fullMessage.decode("utf-8")
 
-			fullMessage = message.getFullMessage()
-			if "binary" != self._mode:
-				fullMessage = fullMessage.decode("utf-8")
-			if "text" == self._mode:
-				fullMessage = fullMessage.encode("utf-8")
+				try:
+					self.onmessage(self, fullMessage, message.messageNumber)
+				except Exception as e:
+					print("exception calling RecvFlow.onmessage", e)
+					traceback.print_exc()
+				return message.totalLength
 
-			try:
-				self.onmessage(self, fullMessage, message.messageNumber)
-			except Exception, e:
-				print "exception calling RecvFlow.onmessage", e
-				traceback.print_exc()
+		self._checkComplete()
+		return None
 
-		if self._complete:
+	def _checkComplete(self):
+		# a paused flow completes only after its held messages are delivered
+		if self._complete and ((0 == len(self._receiveBuffer)) or not self.isOpen):
 			if not self._sentComplete:
 				self._sentComplete = True
 				try:
 					if self.isOpen:
 						self.oncomplete(self)
-				except Exception, e:
-					print "exception calling RecvFlow.oncomplete", e
+				except Exception as e:
+					print("exception calling RecvFlow.oncomplete", e)
 					traceback.print_exc()
 				self.close()
 
@@ -888,10 +1353,167 @@ class RecvFlow(object):
 
 		def getFullMessage(self):
 			if 1 == len(self.fragments):
-				return self.fragments[0]
+				return bytearray(self.fragments[0])
 			return bytearray().join(self.fragments)
 
 
+# an immutable message payload, fragmented once, that can be queued to any
+# number of SendFlows (for example to fan out one live media message to many
+# subscribers). slicing on a fragment boundary answers the precomputed fragment.
+class SharedMessage(object):
+	def __init__(self, data, chunkSize = RTWebSocket.chunkSize):
+		if type(data) == str:
+			data = data.encode('utf-8')
+		elif type(data) != bytes:
+			data = bytes(data)
+		self._chunkSize = max(1, int(chunkSize))
+		self._length = len(data)
+		self._fragments = [data[x:x + self._chunkSize] for x in range(0, len(data), self._chunkSize)]
+		self._encodings = {}
+
+	def __len__(self):
+		return self._length
+
+	def __getitem__(self, key):
+		if not isinstance(key, slice):
+			raise TypeError("SharedMessage only supports slicing")
+		offsetFrom, offsetTo, step = key.indices(self._length)
+		if offsetTo <= offsetFrom:
+			return b''
+		index, start = divmod(offsetFrom, self._chunkSize)
+		fragment = self._fragments[index]
+		if (0 == start) and (offsetTo - offsetFrom == len(fragment)):
+			return fragment
+		if start + offsetTo - offsetFrom <= len(fragment):
+			return fragment[start:start + offsetTo - offsetFrom]
+		lastIndex, end = divmod(offsetTo, self._chunkSize)
+		pieces = [fragment[start:]] + self._fragments[index + 1:lastIndex]
+		if end:
+			pieces.append(self._fragments[lastIndex][:end])
+		return b''.join(pieces)
+
+	@property
+	def chunkSize(self):
+		return self._chunkSize
+
+	def _encodedWith(self, codec):
+		# compress once per codec for all the flows this message is written to
+		encoded = self._encodings.get(codec.key, None)
+		if encoded is None:
+			encoded = SharedMessage(codec.encode(self[:]), self._chunkSize)
+			self._encodings[codec.key] = encoded
+		return encoded
+
+
+# queue data to every open flow in flows, copying and fragmenting it only once.
+# each flow keeps its own offset, flow control, priority and deadlines.
+# answer a dict of WriteReceipts by SendFlow for the flows that were written.
+def writeToFlows(flows, data, startBy = inf, endBy = inf):
+	if not isinstance(data, SharedMessage):
+		owners = [flow._owner for flow in flows if flow.isOpen]
+		data = SharedMessage(data, owners[0].chunkSize if owners else RTWebSocket.chunkSize)
+	receipts = {}
+	for flow in flows:
+		if flow.isOpen:
+			receipts[flow] = flow.write(data, startBy, endBy)
+	return receipts
+
+
+# per-message compression for a flow. each message is compressed independently
+# (so abandoning a message never affects the others) and prefixed with one byte,
+# CODEC_RAW or CODEC_COMPRESSED. messages that don't compress well are sent raw,
+# and after a miss compression isn't attempted again for a growing number of
+# messages, so already-encoded media costs almost nothing.
+class _FlowCodec(object):
+	CODEC_RAW = b"\x00"
+	CODEC_COMPRESSED = b"\x01"
+
+	minLength = 64
+	maxSkip = 64
+	zlibLevel = 6
+	zstdLevel = 3
+
+	def __init__(self, compression, dictionaryID = None):
+		self.compression = compression
+		self.dictionaryID = dictionaryID
+		self._skip = 0
+		self._skipRun = 0
+		self._lock = threading.Lock() # encode can be called from SendFlow.submit producers
+
+		dictionary = None
+		if dictionaryID is not None:
+			dictionary = compressionDictionaries.get(dictionaryID, None)
+			if dictionary is None:
+				raise ValueError("unknown compression dictionary " + repr(dictionaryID))
+
+		# _decompress(data, maxLength) answers at most maxLength + 1 bytes, so a message
+		# that would expand past the limit is detected without expanding all of it.
+		if "zlib" == compression:
+			if dictionary is None:
+				self._compress = lambda data: zlib.compress(data, self.zlibLevel)
+			else:
+				def _compress(data):
+					c = zlib.compressobj(self.zlibLevel, zlib.DEFLATED, zlib.MAX_WBITS, 8, zlib.Z_DEFAULT_STRATEGY, dictionary)
+					return c.compress(data) + c.flush()
+				self._compress = _compress
+			def _decompress(data, maxLength):
+				d = zlib.decompressobj(zlib.MAX_WBITS, dictionary) if dictionary is not None else zlib.decompressobj()
+				rv = d.decompress(data, maxLength + 1)
+				if (len(rv) <= maxLength) and not d.eof:
+					raise ValueError("truncated compressed message")
+				return rv
+			self._decompress = _decompress
+		elif ("zstd" == compression) and (zstandard is not None):
+			zdict = zstandard.ZstdCompressionDict(dictionary) if dictionary is not None else None
+			compressor = zstandard.ZstdCompressor(level = self.zstdLevel, dict_data = zdict)
+			decompressor = zstandard.ZstdDecompressor(dict_data = zdict)
+			self._compress = compressor.compress
+			def _decompress(data, maxLength):
+				with decompressor.stream_reader(data) as reader:
+					return reader.read(maxLength + 1)
+			self._decompress = _decompress
+		else:
+			raise ValueError("unsupported compression " + repr(compression))
+
+	def encode(self, data):
+		if isinstance(data, SharedMessage):
+			return data._encodedWith(self)
+		with self._lock:
+			if (len(data) >= self.minLength) and (self._skip <= 0):
+				compressed = self._compress(data)
+				if len(compressed) < len(data) - (len(data) >> 3):
+					self._skipRun = 0
+					return self.CODEC_COMPRESSED + compressed
+				self._skipRun = min(self.maxSkip, max(1, self._skipRun * 2))
+				self._skip = self._skipRun
+			else:
+				self._skip -= 1
+		return self.CODEC_RAW + data
+
+	def decode(self, data, maxLength = inf):
+		data = bytes(data)
+		flag = data[:1]
+		if self.CODEC_RAW == flag:
+			return data[1:]
+		if self.CODEC_COMPRESSED == flag:
+			rv = self._decompress(data[1:], min(maxLength, sys.maxsize - 1))
+			if len(rv) > maxLength:
+				raise ValueError("decompressed message too large")
+			return rv
+		raise ValueError("unknown message encoding")
+
+	@property
+	def key(self):
+		return (self.compression, self.dictionaryID)
+
+
+def setCompressionDictionary(dictionaryID, data):
+	if type(data) == str:
+		data = data.encode("utf-8")
+	compressionDictionaries[dictionaryID] = bytes(data)
+
+
+
 class WriteReceipt(object):
 	def __init__(self, callLater_f, messageNumber):
 		self._origin = time.time()
@@ -961,6 +1583,11 @@ class WriteReceipt(object):
 	def _onStarted(self):
 		self._started = True
 
+	def _deadline(self):
+		if self._started:
+			return self._origin + self._endBy
+		return self._origin + min(self._startBy, self._endBy)
+
 	def _onSent(self):
 		self._sent = True
 		self._callLater_f(self.onsent, self)
@@ -982,12 +1609,13 @@ def makeVLU(n):
         return bytes(b)
 
 def parseVLU(bytestring, cursor=0, limit=-1):
-        bytestring = bytes(bytestring or '')
+        if bytestring is None:
+                bytestring = b""
         if limit < 0 or limit > len(bytestring):
                 limit = len(bytestring)
         rv = 0
         while cursor < limit:
-                each = ord(bytestring[cursor])
+                each = bytestring[cursor]
                 rv += each & 0x7f
                 cursor += 1
                 if 0 == each & 0x80:
@@ -0,0 +1,111 @@
+# Copyright 2017 Michael Thornburgh
+# SPDX-License-Identifier: MIT
+
+# protocol engine throughput benchmark. drives one RTWebSocket pair joined by a
+# loopback adapter with 8 flows of 100 byte to 20 KB messages and reports
+# messages and bytes delivered per second. runs under Python 2 and 3, so the
+# Python 3 port can be compared with the last Python 2 rtws.py:
+#
+#   mkdir /tmp/rtws2 && git show 798565e^:rtws.py > /tmp/rtws2/rtws.py
+#   python2 rtwsbench.py --rtws /tmp/rtws2
+#   python3 rtwsbench.py
+#
+# --capture records the receiver's traffic for replay with rtwscapture.py.
+
+from collections import deque
+import argparse
+import os
+import sys
+import time
+
+PAYLOAD_SIZES = [100, 1000, 5000, 20000]
+
+
+class _Loop(object):
+	def __init__(self):
+		self.work = deque()
+
+	def run(self):
+		work = self.work
+		while work:
+			work.popleft()()
+
+def _makeAdapterClass(rtws):
+	class _LoopbackAdapter(rtws.IWebSocketAdapter):
+		def __init__(self, loop):
+			self.loop = loop
+			self.peer = None
+			self.owner = None
+
+		def send(self, msg):
+			peer = self.peer.owner
+			self.loop.work.append(lambda: peer.adapter_onReceive(msg))
+
+		def callLater(self, item):
+			self.loop.work.append(item)
+
+	return _LoopbackAdapter
+
+def runBenchmark(rtws, numFlows, rounds, capture = None, out = sys.stdout):
+	loop = _Loop()
+	adapterClass = _makeAdapterClass(rtws)
+	aAdapter = adapterClass(loop)
+	bAdapter = adapterClass(loop)
+	aAdapter.peer = bAdapter
+	bAdapter.peer = aAdapter
+	a = rtws.RTWebSocket(aAdapter)
+	b = rtws.RTWebSocket(bAdapter)
+	aAdapter.owner = a
+	bAdapter.owner = b
+	a.onclose = b.onclose = lambda sender: None
+
+	stats = { "messages": 0, "bytes": 0 }
+	def _onmessage(recvFlow, message, messageNumber):
+		stats["messages"] += 1
+		stats["bytes"] += len(message)
+	def _onrecvflow(recvFlow):
+		recvFlow.accept()
+		recvFlow.onmessage = _onmessage
+		recvFlow.oncomplete = lambda flow: None
+	b.onrecvflow = _onrecvflow
+
+	writer = None
+	if capture:
+		import rtwscapture
+		writer = rtwscapture.CaptureWriter(capture)
+		rtwscapture.record(b, writer)
+
+	flows = [a.openFlow(("flow %d" % each).encode("ascii")) for each in range(numFlows)]
+	payloads = [b"x" * each for each in PAYLOAD_SIZES]
+
+	start = time.time()
+	for rnd in range(rounds):
+		for i, flow in enumerate(flows):
+			flow.write(payloads[(rnd + i) % len(payloads)])
+		loop.run()
+	elapsed = time.time() - start
+
+	if writer:
+		writer.close()
+
+	out.write("Python %d.%d.%d %s: %d messages %d bytes in %.3fs: %.0f msg/s %.1f MB/s\n" % (
+		sys.version_info[0], sys.version_info[1], sys.version_info[2], os.path.abspath(rtws.__file__),
+		stats["messages"], stats["bytes"], elapsed, stats["messages"] / elapsed, stats["bytes"] / elapsed / 1e6))
+	return stats
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description = "RTWebSocket protocol engine throughput benchmark")
+	parser.add_argument("--rtws", metavar = "DIR", help = "directory of the rtws.py to benchmark (default this one)")
+	parser.add_argument("--flows", type = int, default = 8, help = "concurrent flows (default 8)")
+	parser.add_argument("--rounds", type = int, default = 300, help = "messages written per flow (default 300)")
+	parser.add_argument("--capture", metavar = "PATH", help = "record the receiver's traffic to PATH")
+	args = parser.parse_args(argv)
+
+	if args.rtws:
+		sys.path.insert(0, args.rtws)
+	import rtws
+	runBenchmark(rtws, args.flows, args.rounds, args.capture)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,244 @@
+# Copyright 2017 Michael Thornburgh
+# SPDX-License-Identifier: MIT
+
+# capture RTWebSocket wire traffic to a compact binary file, and replay a capture
+# through the protocol engine as a repeatable benchmark.
+#
+# capture file format:
+#   "RTWSCAP1" <8 byte big-endian double start time>
+#   records: <1 byte direction> <vlu microseconds since previous record> <vlu length> <message>
+
+from collections import deque
+import argparse
+import cProfile
+import pstats
+import struct
+import sys
+import time
+
+import rtws
+
+CAPTURE_MAGIC = b"RTWSCAP1"
+
+DIR_IN  = 0x3c # '<'
+DIR_OUT = 0x3e # '>'
+
+MESSAGE_NAMES = {
+	rtws.MSG_PING: "ping",
+	rtws.MSG_PING_REPLY: "ping reply",
+	rtws.MSG_ACK_WINDOW: "ack window",
+	rtws.MSG_FLOW_OPEN: "flow open",
+	rtws.MSG_FLOW_OPEN_RETURN: "flow open return",
+	rtws.MSG_DATA_LAST: "data last",
+	rtws.MSG_DATA_MORE: "data more",
+	rtws.MSG_DATA_ABANDON: "data abandon",
+	rtws.MSG_FLOW_CLOSE: "flow close",
+	rtws.MSG_DATA_ACK: "data ack",
+	rtws.MSG_FLOW_CLOSE_ACK: "flow close ack",
+	rtws.MSG_FLOW_EXCEPTION: "flow exception",
+	rtws.MSG_FLOW_COMPRESSION: "flow compression",
+	rtws.MSG_FLOW_COMPRESSION_ACK: "flow compression ack"
+}
+
+
+class CaptureWriter(object):
+	flushThresh = 65536
+
+	def __init__(self, path):
+		self._file = open(path, "wb")
+		self._last = time.time()
+		self._pending = [CAPTURE_MAGIC, struct.pack("!d", self._last)]
+		self._pendingLength = 0
+
+	def record(self, direction, message):
+		if self._file is None:
+			return
+		now = time.time()
+		delta = int(max(0, now - self._last) * 1000000)
+		self._last = now
+		message = bytes(message)
+		self._pending.extend([bytes([direction]), rtws.makeVLU(delta), rtws.makeVLU(len(message)), message])
+		self._pendingLength += len(message)
+		if self._pendingLength >= self.flushThresh:
+			self.flush()
+
+	def flush(self):
+		if self._file is None:
+			return
+		self._file.write(b"".join(self._pending))
+		self._file.flush()
+		self._pending = []
+		self._pendingLength = 0
+
+	def close(self):
+		if self._file is None:
+			return
+		self.flush()
+		self._file.close()
+		self._file = None
+
+
+class RecordingAdapter(rtws.IWebSocketAdapter):
+	def __init__(self, adapter, writer):
+		self._adapter = adapter
+		self._writer = writer
+
+	def send(self, msg):
+		self._writer.record(DIR_OUT, msg)
+		self._adapter.send(msg)
+
+	def callLater(self, item):
+		self._adapter.callLater(item)
+
+	def callFromThread(self, item):
+		self._adapter.callFromThread(item)
+
+	def close(self):
+		self._adapter.close()
+		self._writer.flush()
+
+
+def record(rtWebSocket, writer):
+	# start capturing all messages sent and received by rtWebSocket to writer.
+	rtWebSocket._adapter = RecordingAdapter(rtWebSocket._adapter, writer)
+	onReceive = rtWebSocket.adapter_onReceive
+	def _recordingOnReceive(message):
+		writer.record(DIR_IN, message)
+		onReceive(message)
+	rtWebSocket.adapter_onReceive = _recordingOnReceive
+
+
+def readCapture(path):
+	# answer a generator of (timestamp, direction, message) for each record in path.
+	with open(path, "rb") as f:
+		data = f.read()
+	if data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+		raise ValueError("not an RTWebSocket capture file")
+	timestamp = struct.unpack("!d", data[8:16])[0]
+	cursor = 16
+	while cursor < len(data):
+		direction = data[cursor]
+		cursor, delta = rtws.parseVLU(data, cursor + 1)
+		cursor, length = rtws.parseVLU(data, cursor)
+		if cursor + length > len(data):
+			raise IndexError("truncated capture record")
+		timestamp += delta / 1000000.0
+		yield timestamp, direction, data[cursor:cursor + length]
+		cursor += length
+
+
+class _ReplayAdapter(rtws.IWebSocketAdapter):
+	def __init__(self):
+		self.work = deque()
+		self.sentMessages = 0
+		self.sentBytes = 0
+
+	def send(self, msg):
+		self.sentMessages += 1
+		self.sentBytes += len(msg)
+
+	def callLater(self, item):
+		self.work.append(item)
+
+	def runWork(self):
+		work = self.work
+		while work:
+			work.popleft()()
+
+
+class ReplayStats(object):
+	def __init__(self):
+		self.messages = 0
+		self.bytes = 0
+		self.elapsed = 0.0
+		self.countByType = {}
+		self.cpuByType = {}
+
+	def add(self, code, length, cpu):
+		self.messages += 1
+		self.bytes += length
+		self.countByType[code] = self.countByType.get(code, 0) + 1
+		self.cpuByType[code] = self.cpuByType.get(code, 0.0) + cpu
+
+	def report(self, out = sys.stdout):
+		rate = self.messages / self.elapsed if self.elapsed > 0 else 0.0
+		out.write("%d messages, %d bytes in %.3fs: %.0f messages/s\n" % (self.messages, self.bytes, self.elapsed, rate))
+		for code in sorted(self.countByType.keys()):
+			count = self.countByType[code]
+			cpu = self.cpuByType[code]
+			out.write("  0x%02x %-18s %9d  %8.3fs  %8.2fus/msg\n" % (code, MESSAGE_NAMES.get(code, "unknown"), count, cpu, cpu * 1000000.0 / count))
+
+
+def replay(path, realtime = False):
+	# feed the inbound messages in the capture at path through a fresh RTWebSocket,
+	# either as fast as possible or paced to the original timing. outbound flow
+	# opens are used to recreate the SendFlows that inbound acks refer to.
+	adapter = _ReplayAdapter()
+	engine = rtws.RTWebSocket(adapter)
+	engine.pingInterval = 0
+	engine.onclose = lambda sender: None
+
+	def _onrecvflow(recvFlow):
+		recvFlow.accept()
+		recvFlow.onmessage = lambda flow, message, number: None
+		recvFlow.oncomplete = lambda flow: None
+	engine.onrecvflow = _onrecvflow
+
+	stats = ReplayStats()
+	firstTimestamp = None
+	replayStart = time.time()
+	for timestamp, direction, message in readCapture(path):
+		if 0 == len(message):
+			continue
+		code = message[0]
+
+		if DIR_OUT == direction:
+			if code in [rtws.MSG_FLOW_OPEN, rtws.MSG_FLOW_OPEN_RETURN]:
+				cursor, flowID = rtws.parseVLU(message, 1)
+				flow = rtws.SendFlow(engine, flowID, None, None)
+				flow._flowOpenMessage = None
+				flow.onexception = lambda sendFlow, code, description: None
+				flow.onrecvflow = _onrecvflow
+				engine._sendFlowsByID[flowID] = flow
+			continue
+
+		if realtime:
+			if firstTimestamp is None:
+				firstTimestamp = timestamp
+			delay = (timestamp - firstTimestamp) - (time.time() - replayStart)
+			if delay > 0:
+				time.sleep(delay)
+
+		begin = time.process_time()
+		engine.adapter_onReceive(message)
+		adapter.runWork()
+		stats.add(code, len(message), time.process_time() - begin)
+
+	engine.adapter_doPeriodicWork()
+	adapter.runWork()
+	stats.elapsed = time.time() - replayStart
+	return stats
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description = "replay an RTWebSocket capture through the protocol engine")
+	parser.add_argument("capture", help = "capture file written by CaptureWriter")
+	parser.add_argument("--realtime", action = "store_true", help = "pace the replay to the original timing")
+	parser.add_argument("--profile", metavar = "SORTKEY", nargs = "?", const = "cumulative",
+		help = "run under cProfile and print statistics sorted by SORTKEY (default cumulative)")
+	parser.add_argument("--profile-output", metavar = "PATH", help = "also save raw cProfile statistics to PATH")
+	args = parser.parse_args(argv)
+
+	if args.profile or args.profile_output:
+		profiler = cProfile.Profile()
+		stats = profiler.runcall(replay, args.capture, args.realtime)
+		if args.profile_output:
+			profiler.dump_stats(args.profile_output)
+		pstats.Stats(profiler).sort_stats(args.profile or "cumulative").print_stats(30)
+	else:
+		stats = replay(args.capture, args.realtime)
+
+	stats.report()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,279 @@
+# Copyright 2017 Michael Thornburgh
+# SPDX-License-Identifier: MIT
+
+# in-process load generator for capacity planning. creates N RTWebSocket
+# connection pairs joined by loopback adapters on one event loop, drives a
+# configurable mix of flows on each, and reports CPU per message, memory per
+# connection and flow, and delivery and scheduling latency as N grows.
+#
+# a flow spec is "size:priority:rate[:startBy[:endBy[:return]]]", for example
+# "1200:5:50:0.2:0.5" for 50 1200 byte messages per second at PRI_IMMEDIATE
+# that must start within 200ms and finish within 500ms, or "200:3:10:::return"
+# for a routine flow whose receiver echoes each message on a return flow.
+
+from collections import deque
+import argparse
+import heapq
+import struct
+import sys
+import time
+import tracemalloc
+
+import rtws
+
+TIMESTAMP = struct.Struct("!d")
+
+
+class FlowSpec(object):
+	def __init__(self, size, priority = rtws.PRI_ROUTINE, rate = 10.0, startBy = rtws.inf, endBy = rtws.inf, returnFlow = False):
+		self.size = max(TIMESTAMP.size, int(size))
+		self.priority = int(priority)
+		self.rate = float(rate)
+		self.startBy = float(startBy)
+		self.endBy = float(endBy)
+		self.returnFlow = bool(returnFlow)
+
+	@classmethod
+	def parse(cls, spec):
+		fields = spec.split(":")
+		if len(fields) < 3:
+			raise ValueError("flow spec needs at least size:priority:rate: " + repr(spec))
+		def _deadline(i):
+			return float(fields[i]) if (len(fields) > i) and fields[i] else rtws.inf
+		return cls(int(fields[0]), int(fields[1]), float(fields[2]), _deadline(3), _deadline(4),
+			(len(fields) > 5) and ("return" == fields[5]))
+
+	def __repr__(self):
+		return "%d:%d:%g:%g:%g%s" % (self.size, self.priority, self.rate, self.startBy, self.endBy, ":return" if self.returnFlow else "")
+
+DEFAULT_FLOWS = [
+	FlowSpec(200, rtws.PRI_FLASH, 5, returnFlow = True), # control and commands
+	FlowSpec(160, rtws.PRI_IMMEDIATE, 50, 0.1, 0.2),      # audio
+	FlowSpec(4000, rtws.PRI_PRIORITY, 30, 0.2, 0.5),      # video
+	FlowSpec(16000, rtws.PRI_BULK, 2)                     # bulk data
+]
+
+
+class EventLoop(object):
+	def __init__(self):
+		self._ready = deque()
+		self._timers = []
+		self._sequence = 0
+		self.lateness = []
+
+	def callSoon(self, item):
+		self._ready.append(item)
+
+	def callAt(self, when, item):
+		self._sequence += 1
+		heapq.heappush(self._timers, (when, self._sequence, item))
+
+	def run(self, duration):
+		stopAt = time.time() + duration
+		ready = self._ready
+		timers = self._timers
+		while True:
+			now = time.time()
+			if now >= stopAt:
+				break
+			while timers and timers[0][0] <= now:
+				when, sequence, item = heapq.heappop(timers)
+				self.lateness.append(now - when)
+				ready.append(item)
+			if ready:
+				for x in range(len(ready)):
+					ready.popleft()()
+			elif timers:
+				time.sleep(max(0, min(timers[0][0], stopAt) - now))
+			else:
+				break
+
+	def runReady(self):
+		ready = self._ready
+		while ready:
+			ready.popleft()()
+
+
+class LoopbackAdapter(rtws.IWebSocketAdapter):
+	def __init__(self, loop):
+		self._loop = loop
+		self.peer = None
+		self.owner = None
+
+	def send(self, msg):
+		peer = self.peer
+		self._loop.callSoon(lambda: peer.owner.adapter_onReceive(msg))
+
+	def callLater(self, item):
+		self._loop.callSoon(item)
+
+	def close(self):
+		pass
+
+
+class LoadStats(object):
+	def __init__(self):
+		self.written = 0
+		self.skipped = 0
+		self.abandoned = 0
+		self.delivered = 0
+		self.deliveredBytes = 0
+		self.latency = []
+
+	def onabandoned(self, receipt):
+		self.abandoned += 1
+
+
+def _percentile(samples, fraction):
+	if not samples:
+		return 0.0
+	samples = sorted(samples)
+	return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class LoadTest(object):
+	periodicInterval = 0.05
+
+	def __init__(self, numConnections, flowSpecs):
+		self.numConnections = numConnections
+		self.flowSpecs = flowSpecs
+		self.loop = EventLoop()
+		self.stats = LoadStats()
+		self.connections = []
+		self.sendFlows = []
+
+	def _makePair(self):
+		loop = self.loop
+		clientAdapter = LoopbackAdapter(loop)
+		serverAdapter = LoopbackAdapter(loop)
+		clientAdapter.peer = serverAdapter
+		serverAdapter.peer = clientAdapter
+		client = rtws.RTWebSocket(clientAdapter)
+		server = rtws.RTWebSocket(serverAdapter)
+		clientAdapter.owner = client
+		serverAdapter.owner = server
+		client.onclose = server.onclose = lambda sender: None
+		server.onrecvflow = self._onServerRecvFlow
+		return client, server
+
+	def _onMessage(self, recvFlow, message, number):
+		stats = self.stats
+		stats.delivered += 1
+		stats.deliveredBytes += len(message)
+		stats.latency.append(time.time() - TIMESTAMP.unpack_from(message)[0])
+
+	def _onServerRecvFlow(self, recvFlow):
+		recvFlow.accept()
+		recvFlow.oncomplete = lambda flow: None
+		spec = self.flowSpecs[int(recvFlow.textMetadata)]
+		if not spec.returnFlow:
+			recvFlow.onmessage = self._onMessage
+			return
+
+		returnFlow = recvFlow.openReturnFlow(b"return", spec.priority)
+		returnFlow.onexception = lambda sendFlow, code, description: None
+		def _onmessage(flow, message, number):
+			self._onMessage(flow, message, number)
+			if returnFlow.isOpen:
+				returnFlow.write(message, spec.startBy, spec.endBy)
+		recvFlow.onmessage = _onmessage
+
+	def _onClientRecvFlow(self, recvFlow):
+		recvFlow.accept()
+		recvFlow.onmessage = self._onMessage
+		recvFlow.oncomplete = lambda flow: None
+
+	def setup(self):
+		for x in range(self.numConnections):
+			client, server = self._makePair()
+			self.connections.extend([client, server])
+			for index, spec in enumerate(self.flowSpecs):
+				flow = client.openFlow(str(index), spec.priority)
+				flow.onexception = lambda sendFlow, code, description: None
+				flow.onrecvflow = self._onClientRecvFlow
+				self.sendFlows.append((flow, spec))
+		self.loop.runReady()
+
+	def _schedulePeriodicWork(self, connection, when):
+		def _work():
+			if connection.isOpen:
+				connection.adapter_doPeriodicWork()
+				self._schedulePeriodicWork(connection, when + self.periodicInterval)
+		self.loop.callAt(when, _work)
+
+	def _scheduleWrite(self, flow, spec, when, padding):
+		stats = self.stats
+		def _write():
+			if not flow.isOpen:
+				return
+			if flow.writable:
+				receipt = flow.write(TIMESTAMP.pack(time.time()) + padding, spec.startBy, spec.endBy)
+				receipt.onabandoned = stats.onabandoned
+				stats.written += 1
+			else:
+				stats.skipped += 1
+			self._scheduleWrite(flow, spec, when + 1.0 / spec.rate, padding)
+		self.loop.callAt(when, _write)
+
+	def run(self, duration):
+		now = time.time()
+		for index, connection in enumerate(self.connections):
+			# spread periodic work and writes so connections don't all fire at once
+			offset = self.periodicInterval * index / len(self.connections)
+			self._schedulePeriodicWork(connection, now + offset)
+		for index, (flow, spec) in enumerate(self.sendFlows):
+			if spec.rate > 0:
+				offset = (1.0 / spec.rate) * index / len(self.sendFlows)
+				self._scheduleWrite(flow, spec, now + offset, b"\0" * (spec.size - TIMESTAMP.size))
+
+		cpuStart = time.process_time()
+		self.loop.run(duration)
+		self.cpu = time.process_time() - cpuStart
+		self.duration = duration
+
+	def report(self, out = sys.stdout):
+		stats = self.stats
+		cpuPerMessage = self.cpu / stats.delivered if stats.delivered else 0.0
+		lateness = self.loop.lateness
+		out.write("%6d conns %7d flows: %8.0f msg/s %7.1fus cpu/msg %5.0f%% cpu  latency p50 %7.2fms p99 %8.2fms max %8.2fms  loop lag p99 %7.2fms  abandoned %d skipped %d\n" % (
+			self.numConnections, len(self.sendFlows),
+			stats.delivered / self.duration, cpuPerMessage * 1000000.0, 100.0 * self.cpu / self.duration,
+			_percentile(stats.latency, 0.5) * 1000.0, _percentile(stats.latency, 0.99) * 1000.0,
+			max(stats.latency or [0]) * 1000.0, _percentile(lateness, 0.99) * 1000.0,
+			stats.abandoned, stats.skipped))
+
+
+def runLoadTest(numConnections, flowSpecs, duration, out = sys.stdout):
+	test = LoadTest(numConnections, flowSpecs)
+
+	tracemalloc.start()
+	baseline = tracemalloc.get_traced_memory()[0]
+	test.setup()
+	memory = tracemalloc.get_traced_memory()[0] - baseline
+	tracemalloc.stop()
+
+	numFlows = len(test.sendFlows)
+	out.write("%6d conns %7d flows: %.1f KB/connection pair, %.2f KB/flow (setup)\n" % (
+		numConnections, numFlows, memory / 1024.0 / numConnections, memory / 1024.0 / max(1, numFlows)))
+
+	test.run(duration)
+	test.report(out)
+	return test
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description = "RTWebSocket in-process load generator")
+	parser.add_argument("--connections", default = "1,10,100,1000",
+		help = "comma separated connection pair counts to step through (default 1,10,100,1000)")
+	parser.add_argument("--flow", action = "append", metavar = "SPEC",
+		help = "flow spec size:priority:rate[:startBy[:endBy[:return]]], repeatable (default a mixed media profile)")
+	parser.add_argument("--duration", type = float, default = 5.0, help = "seconds to run each step (default 5)")
+	args = parser.parse_args(argv)
+
+	flowSpecs = [FlowSpec.parse(each) for each in args.flow] if args.flow else DEFAULT_FLOWS
+	sys.stdout.write("flows per connection: %s\n" % (" ".join(repr(each) for each in flowSpecs)))
+	for numConnections in [int(each) for each in args.connections.split(",")]:
+		runLoadTest(numConnections, flowSpecs, args.duration)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
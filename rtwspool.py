@@ -0,0 +1,150 @@
+# Copyright 2017 Michael Thornburgh
+# SPDX-License-Identifier: MIT
+
+# a client-side pool of RTWebSockets to the same endpoint. new flows are placed
+# on the connection with the lowest estimated delay, computed from its RTT,
+# bytes in flight and queued bytes, so bulk transfers spread across several TCP
+# congestion windows while interactive flows stay on a lightly loaded connection.
+# a connection that closes is replaced transparently for future flows. shrinking
+# the pool retires connections: they take no new flows and close once their flows
+# have finished.
+
+import traceback
+
+import rtws
+
+
+class RTWebSocketPool(object):
+	interactivePriority = rtws.PRI_PRIORITY
+	interactivePenalty = 1.0 # extra cost, in RTTs, per interactive flow when placing a bulk flow
+	flowPenalty = 0.1 # extra cost, in RTTs, per open flow, to spread flows that haven't sent yet
+
+	def __init__(self, connect_f, size = 2):
+		# connect_f() answers a new RTWebSocket (with its adapter) to the endpoint.
+		self._connect_f = connect_f
+		self._size = max(1, int(size))
+		self._connections = []
+		self._retiring = []
+		self._flowsByConnection = {}
+		self._isOpen = True
+		self.maintain()
+
+	def openFlow(self, metadata, pri = rtws.PRI_ROUTINE, compression = None, dictionaryID = None):
+		if not self._isOpen:
+			raise IOError("not open")
+		self.maintain()
+		connection = self.placeFlow(pri)
+		if connection is None:
+			raise IOError("no open connections")
+		flow = connection.openFlow(metadata, pri, compression, dictionaryID)
+		self._flowsByConnection[connection].append(flow)
+		return flow
+
+	def placeFlow(self, pri = rtws.PRI_ROUTINE):
+		# answer the open connection on which a new flow of priority pri would go
+		best = None
+		bestCost = rtws.inf
+		for connection in self._connections:
+			if (not connection.isOpen) or (connection in self._retiring):
+				continue
+			cost = self._connectionCost(connection, pri)
+			if cost < bestCost:
+				best, bestCost = connection, cost
+		return best
+
+	def maintain(self):
+		# close retired connections whose flows have finished, and open connections until
+		# the pool is full. called automatically; call it periodically to replace failed
+		# connections before the next openFlow and to close drained retired connections.
+		for connection in list(self._retiring):
+			if connection.isOpen and self._isIdle(connection):
+				connection.close()
+		while self._isOpen and (len(self._connections) - len(self._retiring) < self._size):
+			try:
+				connection = self._connect_f()
+			except Exception as e:
+				print("RTWebSocketPool connect error", e)
+				traceback.print_exc()
+				break
+			self._addConnection(connection)
+
+	def close(self):
+		if not self._isOpen:
+			return
+		self._isOpen = False
+		for connection in list(self._connections):
+			connection.close()
+
+	@property
+	def isOpen(self):
+		return self._isOpen
+
+	@property
+	def connections(self):
+		return list(self._connections)
+
+	@property
+	def size(self):
+		return self._size
+	@size.setter
+	def size(self, val):
+		self._size = max(1, int(val))
+		active = [each for each in self._connections if each not in self._retiring]
+		for connection in [each for each in self._retiring if each.isOpen]:
+			if len(active) >= self._size:
+				break
+			self._retiring.remove(connection) # reinstate before connecting anew
+			active.append(connection)
+		excess = len(active) - self._size
+		if excess > 0:
+			# retire the connections with the fewest open flows, they'll drain soonest
+			active.sort(key = lambda each: len(self._openFlows(each)))
+			self._retiring.extend(active[:excess])
+		self.maintain()
+
+	def onrecvflow(self, recvFlow):
+		print("onrecvflow", recvFlow)
+
+	def onconnectionclose(self, pool, connection):
+		pass
+
+	def _addConnection(self, connection):
+		self._connections.append(connection)
+		self._flowsByConnection[connection] = []
+		connection.onrecvflow = lambda recvFlow: self.onrecvflow(recvFlow)
+		connection.onclose = self._onConnectionClose
+
+	def _onConnectionClose(self, connection):
+		if connection in self._flowsByConnection:
+			self._connections.remove(connection)
+			del self._flowsByConnection[connection]
+		if connection in self._retiring:
+			self._retiring.remove(connection)
+		try:
+			self.onconnectionclose(self, connection)
+		except Exception as e:
+			print("exception calling RTWebSocketPool.onconnectionclose", e)
+			traceback.print_exc()
+		self.maintain()
+
+	def _isIdle(self, connection):
+		# true when every flow on connection, in both directions, has completely closed
+		return not (connection._sendFlowsByID or connection._recvFlowsByID)
+
+	def _openFlows(self, connection):
+		flows = [flow for flow in self._flowsByConnection[connection] if flow.isOpen]
+		self._flowsByConnection[connection] = flows
+		return flows
+
+	def _connectionCost(self, connection, pri):
+		# estimated delay for new data: one RTT, plus the time to drain what is already
+		# in flight and queued at about one window per RTT.
+		rtt = connection.rtt
+		backlog = connection.bytesInflight + connection.bufferLength
+		cost = rtt * (1.0 + float(backlog) / max(1, connection.outstandingThresh))
+		flows = self._openFlows(connection)
+		cost += rtt * self.flowPenalty * len(flows)
+		if pri < self.interactivePriority:
+			numInteractive = len([flow for flow in flows if flow.priority >= self.interactivePriority])
+			cost += rtt * self.interactivePenalty * numInteractive
+		return cost
@@ -0,0 +1,248 @@
+# Copyright 2017 Michael Thornburgh
+# SPDX-License-Identifier: MIT
+
+# record the messages received on a RecvFlow to an indexed, segmented log on
+# disk, and read a recording back with random access for replay.
+#
+# a recording is a directory of segments. each segment is a pair of files:
+#   NNNNNNNN.log: the messages, concatenated
+#   NNNNNNNN.idx: one INDEX_ENTRY per message:
+#                 <u64 messageNumber> <f64 timestamp> <u64 offset in .log> <u32 length>
+#
+# writes are batched and done on a background thread so the event loop never
+# blocks on the disk. if the disk falls behind, the RecvFlow is paused (so its
+# receive window closes and the sender is flow controlled) until it catches up.
+
+from bisect import bisect_left
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+INDEX_ENTRY = struct.Struct("!QdQI")
+
+
+def _segmentPaths(directory, segmentNumber):
+	base = os.path.join(directory, "%08d" % segmentNumber)
+	return base + ".log", base + ".idx"
+
+
+class FlowRecorder(object):
+	segmentSize = 64 * 1024 * 1024
+	batchSize = 256 * 1024
+	maxPendingBytes = 8 * 1024 * 1024 # pause the flow above this, resume below half
+
+	def __init__(self, recvFlow, directory):
+		self._recvFlow = recvFlow
+		self._directory = directory
+		self._queue = queue.Queue()
+		self._pendingLock = threading.Lock()
+		self._pendingBytes = 0
+		self._pausedForDisk = False
+		self._closed = False
+		self.messagesRecorded = 0
+		self.error = None
+
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		# message numbers start again at 1 on each flow, so a directory holds one recording
+		if any(os.path.exists(each) for each in _segmentPaths(directory, 0)):
+			raise IOError("recording already exists in " + directory)
+
+		self._onmessage = recvFlow.onmessage
+		self._oncomplete = recvFlow.oncomplete
+		recvFlow.onmessage = self._onRecvFlowMessage
+		recvFlow.oncomplete = self._onRecvFlowComplete
+
+		self._thread = threading.Thread(target = self._writerLoop, name = "FlowRecorder " + directory)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def close(self, wait = True):
+		# stop recording. queued messages are still written. if wait, block until they are.
+		if not self._closed:
+			self._closed = True
+			if self._recvFlow.onmessage == self._onRecvFlowMessage:
+				self._recvFlow.onmessage = self._onmessage
+				self._recvFlow.oncomplete = self._oncomplete
+			self._queue.put(None)
+		if wait:
+			self._thread.join()
+
+	@property
+	def pendingBytes(self):
+		return self._pendingBytes
+
+	def onerror(self, recorder, exception):
+		print("FlowRecorder write error", exception)
+
+	def _onRecvFlowMessage(self, recvFlow, message, number):
+		if not self._closed:
+			data = message.encode("utf-8") if type(message) == str else bytes(message)
+			with self._pendingLock:
+				self._pendingBytes += len(data)
+				pending = self._pendingBytes
+			# pause before queuing, so the writer sees the pause when it drains this message
+			if (pending > self.maxPendingBytes) and not self._pausedForDisk:
+				self._pausedForDisk = True
+				recvFlow.paused = True
+			self._queue.put((number, time.time(), data))
+		if self._onmessage:
+			self._onmessage(recvFlow, message, number)
+
+	def _onRecvFlowComplete(self, recvFlow):
+		self.close(wait = False)
+		if self._oncomplete:
+			self._oncomplete(recvFlow)
+
+	def _resume(self):
+		# on the event loop thread
+		if self._pausedForDisk and self._pendingBytes <= self.maxPendingBytes // 2:
+			self._pausedForDisk = False
+			self._recvFlow.paused = False
+
+	def _onWritten(self, numBytes):
+		# on the writer thread
+		with self._pendingLock:
+			self._pendingBytes -= numBytes
+			pending = self._pendingBytes
+		if self._pausedForDisk and (pending <= self.maxPendingBytes // 2):
+			self._recvFlow._owner.callFromThread(self._resume)
+
+	def _writerLoop(self):
+		segmentNumber = 0
+		logFile = indexFile = None
+		offset = 0
+		done = False
+
+		try:
+			while not done:
+				batch = [self._queue.get()]
+				batchBytes = len(batch[0][2]) if batch[0] else 0
+				while (batchBytes < self.batchSize) and not self._queue.empty():
+					item = self._queue.get_nowait()
+					batch.append(item)
+					if item is not None:
+						batchBytes += len(item[2])
+
+				messages = []
+				entries = []
+				writtenBytes = 0
+				for item in batch:
+					if item is None:
+						done = True
+						break
+					number, timestamp, message = item
+					if (logFile is None) or ((offset > 0) and (offset + len(message) > self.segmentSize)):
+						if logFile is not None:
+							self._writeBatch(logFile, indexFile, messages, entries)
+							writtenBytes += sum(len(each) for each in messages)
+							messages, entries = [], []
+							logFile.close()
+							indexFile.close()
+							segmentNumber += 1
+						logPath, indexPath = _segmentPaths(self._directory, segmentNumber)
+						logFile = open(logPath, "wb")
+						indexFile = open(indexPath, "wb")
+						offset = 0
+					messages.append(message)
+					entries.append(INDEX_ENTRY.pack(number, timestamp, offset, len(message)))
+					offset += len(message)
+
+				if logFile is not None:
+					self._writeBatch(logFile, indexFile, messages, entries)
+				self._onWritten(writtenBytes + sum(len(each) for each in messages))
+		except Exception as e:
+			self.error = e
+			self._recvFlow._owner.callFromThread(self.onerror, self, e)
+		finally:
+			if logFile is not None:
+				logFile.close()
+				indexFile.close()
+
+	def _writeBatch(self, logFile, indexFile, messages, entries):
+		logFile.write(b"".join(messages))
+		logFile.flush()
+		indexFile.write(b"".join(entries))
+		indexFile.flush()
+		self.messagesRecorded += len(entries)
+
+
+class FlowRecording(object):
+	# random access to a recording made by FlowRecorder. message data is answered as
+	# memoryviews into memory-mapped segments. close() unmaps the segments once any
+	# views still held into them are released.
+
+	def __init__(self, directory):
+		self._maps = []
+		self._numbers = []
+		self._timestamps = []
+		self._locations = [] # (segment, offset, length)
+
+		segmentNumber = 0
+		while True:
+			logPath, indexPath = _segmentPaths(directory, segmentNumber)
+			if not os.path.exists(indexPath):
+				break
+			with open(indexPath, "rb") as f:
+				index = f.read()
+			with open(logPath, "rb") as f:
+				logMap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+			segment = len(self._maps)
+			self._maps.append(logMap)
+			for each in INDEX_ENTRY.iter_unpack(index[:len(index) - len(index) % INDEX_ENTRY.size]):
+				number, timestamp, offset, length = each
+				if offset + length > len(logMap):
+					break # entry written ahead of a torn log write
+				self._numbers.append(number)
+				self._timestamps.append(timestamp)
+				self._locations.append((segment, offset, length))
+			segmentNumber += 1
+
+	def close(self):
+		# a segment can't be unmapped while a message view into it is still held. dropping
+		# our reference instead leaves it to be unmapped when the last view is released.
+		for each in self._maps:
+			if isinstance(each, mmap.mmap):
+				try:
+					each.close()
+				except BufferError:
+					pass
+		self._maps = []
+
+	def __len__(self):
+		return len(self._numbers)
+
+	def __getitem__(self, i):
+		# answer (messageNumber, timestamp, message) for the i'th recorded message
+		segment, offset, length = self._locations[i]
+		return self._numbers[i], self._timestamps[i], memoryview(self._maps[segment])[offset:offset + length]
+
+	def indexOfMessageNumber(self, messageNumber):
+		# answer the index of the first recorded message numbered at least messageNumber
+		return bisect_left(self._numbers, messageNumber)
+
+	def indexOfTime(self, timestamp):
+		# answer the index of the first message recorded at or after timestamp
+		return bisect_left(self._timestamps, timestamp)
+
+	def replay(self, sendFlow, first = 0, last = None, onfinished = None):
+		# write recorded messages first through last (inclusive, default the end) to
+		# sendFlow as it becomes writable, then call onfinished(sendFlow) if set.
+		state = {"next": first}
+		last = len(self) - 1 if last is None else min(last, len(self) - 1)
+
+		def _onwritable(flow):
+			while flow.writable and (state["next"] <= last):
+				flow.write(self[state["next"]][2])
+				state["next"] += 1
+			if state["next"] <= last:
+				return True
+			if onfinished:
+				onfinished(flow)
+			return False
+
+		sendFlow.onwritable = _onwritable
+		sendFlow.notifyWhenWritable()
@@ -0,0 +1,662 @@
+# Copyright 2017 Michael Thornburgh
+# SPDX-License-Identifier: MIT
+
+# protocol tests for rtws.py over an in-memory loopback. run with
+#   python3 -m unittest test_rtws
+
+from collections import deque
+import time
+import unittest
+
+import rtws
+from rtws import parseVLU, makeVLU
+
+
+class _Loop(object):
+	def __init__(self):
+		self.work = deque()
+
+	def run(self):
+		work = self.work
+		while work:
+			work.popleft()()
+
+class _LoopbackAdapter(rtws.IWebSocketAdapter):
+	def __init__(self, loop):
+		self.loop = loop
+		self.peer = None
+		self.owner = None
+		self.sent = []
+		self.closed = False
+
+	def send(self, msg):
+		msg = bytes(msg)
+		self.sent.append(msg)
+		peer = self.peer
+		self.loop.work.append(lambda: peer.owner.adapter_onReceive(msg))
+
+	def callLater(self, item):
+		self.loop.work.append(item)
+
+	def close(self):
+		self.closed = True
+
+	def codes(self):
+		return [each[0] for each in self.sent]
+
+	def messages(self, code):
+		return [each for each in self.sent if each[0] == code]
+
+
+class RTWebSocketTestCase(unittest.TestCase):
+	def setUp(self):
+		self.loop = _Loop()
+		self.aAdapter = _LoopbackAdapter(self.loop)
+		self.bAdapter = _LoopbackAdapter(self.loop)
+		self.aAdapter.peer = self.bAdapter
+		self.bAdapter.peer = self.aAdapter
+		self.a = rtws.RTWebSocket(self.aAdapter)
+		self.b = rtws.RTWebSocket(self.bAdapter)
+		self.aAdapter.owner = self.a
+		self.bAdapter.owner = self.b
+		self.a.onclose = self.b.onclose = lambda sender: None
+
+		self.recvFlows = []
+		self.received = []
+		self.completed = []
+		self.b.onrecvflow = self._acceptFlow
+
+	def _acceptFlow(self, recvFlow):
+		recvFlow.accept()
+		recvFlow.onmessage = lambda flow, message, number: self.received.append((bytes(message), number))
+		recvFlow.oncomplete = lambda flow: self.completed.append(flow)
+		self.recvFlows.append(recvFlow)
+
+	def test_vlu(self):
+		for n in [0, 1, 127, 128, 16383, 16384, 2**32, 2**53 - 1]:
+			encoded = makeVLU(n)
+			self.assertEqual(parseVLU(encoded, 0), (len(encoded), n))
+		self.assertEqual(makeVLU(127), b"\x7f")
+		self.assertEqual(makeVLU(128), b"\x81\x00")
+
+	def test_ping(self):
+		self.a._lastReceive = 0
+		self.a.adapter_doPeriodicWork()
+		self.assertEqual(self.aAdapter.codes(), [rtws.MSG_PING])
+		self.assertIsNotNone(self.a._pingSentAt)
+		self.loop.run()
+
+		ping = self.aAdapter.messages(rtws.MSG_PING)[0]
+		pingReply = self.bAdapter.messages(rtws.MSG_PING_REPLY)[0]
+		self.assertEqual(len(ping), 9)
+		self.assertEqual(pingReply[1:], ping[1:])
+		self.assertIsNone(self.a._pingSentAt)
+
+	def test_ping_reply_mismatch_ignored(self):
+		self.a._lastReceive = 0
+		self.a.adapter_doPeriodicWork()
+		self.a.adapter_onReceive(bytes([rtws.MSG_PING_REPLY]) + b"\x00" * 8)
+		self.assertIsNotNone(self.a._pingSentAt)
+
+	def test_ack_window(self):
+		flow = self.a.openFlow(b"window")
+		flow.write(b"x" * 5000)
+		self.loop.run()
+
+		ackWindows = self.aAdapter.messages(rtws.MSG_ACK_WINDOW)
+		self.assertTrue(ackWindows)
+		cursor, ackWindow = parseVLU(ackWindows[0], 1)
+		self.assertEqual(cursor, len(ackWindows[0]))
+		self.assertEqual(self.b._ackWindow, max(ackWindow, self.b.minAckWindow))
+
+		self.b.adapter_onReceive(bytes([rtws.MSG_ACK_WINDOW]) + makeVLU(20000))
+		self.assertEqual(self.b._ackWindow, 20000)
+		self.b.adapter_onReceive(bytes([rtws.MSG_ACK_WINDOW]) + makeVLU(1))
+		self.assertEqual(self.b._ackWindow, self.b.minAckWindow)
+
+	def test_flow_open(self):
+		flow = self.a.openFlow(b"metadata", rtws.PRI_PRIORITY)
+		self.loop.run()
+
+		opens = self.aAdapter.messages(rtws.MSG_FLOW_OPEN)
+		self.assertEqual(len(opens), 1)
+		cursor, flowID = parseVLU(opens[0], 1)
+		self.assertEqual(opens[0][cursor:], b"metadata")
+		self.assertEqual(flowID, flow._flowID)
+
+		self.assertEqual(len(self.recvFlows), 1)
+		self.assertEqual(bytes(self.recvFlows[0].metadata), b"metadata")
+		self.assertEqual(self.recvFlows[0].textMetadata, "metadata")
+		self.assertTrue(self.recvFlows[0].isOpen)
+
+		# the receiver acks a new flow immediately with its buffer advertisement
+		acks = self.bAdapter.messages(rtws.MSG_DATA_ACK)
+		cursor, ackFlowID = parseVLU(acks[0], 1)
+		cursor, deltaBytes = parseVLU(acks[0], cursor)
+		cursor, advertisement = parseVLU(acks[0], cursor)
+		self.assertEqual((ackFlowID, deltaBytes), (flowID, 0))
+		self.assertEqual(flow.rcvbuf, advertisement)
+
+	def test_flow_open_return(self):
+		returned = []
+		returnFlows = []
+		def onrecvflow(recvFlow):
+			self._acceptFlow(recvFlow)
+			returnFlows.append(recvFlow.openReturnFlow(b"reply"))
+			returnFlows[0].write(b"answer")
+		self.b.onrecvflow = onrecvflow
+
+		flow = self.a.openFlow(b"request")
+		def onReturnFlow(recvFlow):
+			recvFlow.accept()
+			recvFlow.onmessage = lambda f, message, number: returned.append((recvFlow, bytes(message)))
+		flow.onrecvflow = onReturnFlow
+		self.loop.run()
+
+		openReturns = self.bAdapter.messages(rtws.MSG_FLOW_OPEN_RETURN)
+		self.assertEqual(len(openReturns), 1)
+		cursor, flowID = parseVLU(openReturns[0], 1)
+		cursor, returnAssociation = parseVLU(openReturns[0], cursor)
+		self.assertEqual(returnAssociation, flow._flowID)
+		self.assertEqual(openReturns[0][cursor:], b"reply")
+
+		self.assertEqual(len(returned), 1)
+		self.assertEqual(returned[0][1], b"answer")
+		self.assertIs(returned[0][0].associatedSendFlow, flow)
+
+	def test_flow_open_return_unknown_association(self):
+		self.b.adapter_onReceive(bytes([rtws.MSG_FLOW_OPEN_RETURN]) + makeVLU(5) + makeVLU(99) + b"orphan")
+		self.assertEqual(self.recvFlows, [])
+		exceptionMessages = self.bAdapter.messages(rtws.MSG_FLOW_EXCEPTION)
+		self.assertEqual(exceptionMessages, [bytes([rtws.MSG_FLOW_EXCEPTION]) + makeVLU(5) + makeVLU(0) + b"return association not found"])
+
+	def test_data_last_and_more(self):
+		flow = self.a.openFlow(b"data")
+		small = b"small"
+		large = bytes(range(256)) * 40
+		flow.write(small)
+		flow.write(large)
+		flow.write(b"")
+		self.loop.run()
+
+		self.assertEqual(self.received, [(small, 1), (large, 2), (b"", 3)])
+
+		codes = self.aAdapter.codes()
+		self.assertEqual(codes.count(rtws.MSG_DATA_LAST), 3)
+		more = self.aAdapter.messages(rtws.MSG_DATA_MORE)
+		self.assertEqual(len(more), (len(large) - 1) // self.a.chunkSize)
+
+		reassembled = b""
+		for each in self.aAdapter.sent:
+			if each[0] in [rtws.MSG_DATA_MORE, rtws.MSG_DATA_LAST]:
+				cursor, flowID = parseVLU(each, 1)
+				self.assertEqual(flowID, flow._flowID)
+				reassembled += each[cursor:]
+		self.assertEqual(reassembled, small + large)
+
+	def _fragmentRanges(self, flow):
+		ranges = []
+		offset = 0
+		for each in self.aAdapter.sent:
+			if each[0] in [rtws.MSG_DATA_MORE, rtws.MSG_DATA_LAST]:
+				cursor, flowID = parseVLU(each, 1)
+				if flowID == flow._flowID:
+					ranges.append((offset, offset + len(each) - cursor))
+					offset = 0 if each[0] == rtws.MSG_DATA_LAST else offset + len(each) - cursor
+		return ranges
+
+	def test_shared_message_fragments_stay_aligned(self):
+		flow = self.a.openFlow(b"shared")
+		self.loop.run()
+		self.recvFlows[0].rcvbuf = 3000 # window limited, so fragments are cut short
+		self.loop.run()
+		large = bytes(range(256)) * 80
+		shared = rtws.SharedMessage(large, 1400)
+		self.a.chunkSize = 1000
+		rtws.writeToFlows([flow], shared)
+		self.loop.run()
+
+		self.assertEqual(self.received, [(large, 1)])
+		ranges = self._fragmentRanges(flow)
+		for start, end in ranges:
+			self.assertEqual(start // 1400, (end - 1) // 1400)
+			self.assertLessEqual(end - start, 1000)
+		self.assertGreater(len(ranges), len(large) // 1000)
+
+	def test_shared_message_chunk_size_follows_connection(self):
+		self.a.chunkSize = 1000
+		flow = self.a.openFlow(b"shared")
+		receipt = rtws.writeToFlows([flow], b"s" * 5000)[flow]
+		self.assertEqual(flow._sendBuffer[0].data.chunkSize, 1000)
+		self.loop.run()
+		self.assertTrue(receipt.sent)
+		self.assertEqual(self._fragmentRanges(flow), [(0, 1000), (1000, 2000), (2000, 3000), (3000, 4000), (4000, 5000)])
+
+	def test_text_mode(self):
+		flow = self.a.openFlow(b"text")
+		flow.write("héllo")
+		self.loop.run()
+		self.assertEqual(self.received, [("héllo".encode("utf-8"), 1)])
+
+	def test_data_abandon(self):
+		flow = self.a.openFlow(b"abandon")
+		flow.write(b"one")
+		two = flow.write(b"two")
+		three = flow.write(b"three")
+		flow.write(b"four")
+		two.abandon()
+		three.abandon()
+		self.loop.run()
+
+		self.assertTrue(two.abandoned)
+		self.assertFalse(two.sent)
+		self.assertEqual(self.received, [(b"one", 1), (b"four", 4)])
+
+		abandons = self.aAdapter.messages(rtws.MSG_DATA_ABANDON)
+		self.assertEqual(len(abandons), 1)
+		cursor, flowID = parseVLU(abandons[0], 1)
+		cursor, countMinusOne = parseVLU(abandons[0], cursor)
+		self.assertEqual((flowID, countMinusOne), (flow._flowID, 1))
+
+	def test_data_abandon_started_message(self):
+		flow = self.a.openFlow(b"abandon")
+		self.loop.run()
+		receipt = flow.write(b"z" * (self.a.chunkSize * 4))
+		flow.write(b"after")
+		flow._transmit(flow.priority)
+		self.assertTrue(receipt.started)
+		receipt.abandon()
+		self.loop.run()
+
+		self.assertEqual(self.received, [(b"after", 2)])
+		abandons = self.aAdapter.messages(rtws.MSG_DATA_ABANDON)
+		self.assertEqual(len(abandons), 1)
+		cursor, flowID = parseVLU(abandons[0], 1)
+		self.assertEqual(cursor, len(abandons[0]))
+
+	def test_conflation(self):
+		flow = self.a.openFlow(b"latest")
+		flow.conflate = True
+		self.loop.run()
+		first = flow.write(b"1", key = "x")
+		flow.write(b"a", key = "y")
+		flow.write(b"2", key = "x")
+		self.assertTrue(first.abandoned)
+		self.loop.run()
+		self.assertEqual(self.received, [(b"2", 1), (b"a", 2)])
+
+		# slots are released once their messages are sent or trimmed
+		self.assertEqual(flow._conflationSlots, {})
+		abandoned = flow.write(b"3", key = "x")
+		abandoned.abandon()
+		self.loop.run()
+		self.assertEqual(flow._conflationSlots, {})
+		for each in range(100):
+			flow.write(b"v", key = each)
+		self.loop.run()
+		self.assertEqual(flow._conflationSlots, {})
+
+		# a replacement keeps its queue position, so the queue isn't oldest first
+		self.received = []
+		flow.write(b"a1", key = "a")
+		b = flow.write(b"b", endBy = 5, key = "b")
+		for message in flow._sendBuffer:
+			message.receipt._origin -= 0.2
+		a2 = flow.write(b"a2", key = "a")
+
+		self.assertGreaterEqual(flow.unsentAge, 0.2)
+		self.assertEqual(flow._nextDeadline(), b._deadline())
+		flow.abandonQueuedMessages(0.1)
+		self.assertTrue(b.abandoned)
+		self.assertFalse(a2.abandoned)
+		self.loop.run()
+		self.assertEqual(self.received, [(b"a2", 104)])
+
+	def _openFlows(self, *priorities):
+		flows = [self.a.openFlow(("flow %d" % each).encode("ascii"), pri) for each, pri in enumerate(priorities)]
+		self.loop.run()
+		return flows
+
+	def _sendOrder(self, flows):
+		# answer the indexes in flows of the data messages sent, in order
+		flowIDs = [flow._flowID for flow in flows]
+		order = []
+		for each in self.aAdapter.sent:
+			if each[0] == rtws.MSG_DATA_LAST:
+				order.append(flowIDs.index(parseVLU(each, 1)[1]))
+		return order
+
+	def test_deadline_within_band(self):
+		self.a.scheduling = "deadline"
+		flows = self._openFlows(rtws.PRI_ROUTINE, rtws.PRI_ROUTINE, rtws.PRI_ROUTINE, rtws.PRI_ROUTINE)
+		flows[0].write(b"0", endBy = 3)
+		flows[1].write(b"1", endBy = 1)
+		flows[2].write(b"2")
+		flows[3].write(b"3", startBy = 2)
+		self.loop.run()
+		self.assertEqual(self._sendOrder(flows), [1, 3, 0, 2])
+
+	def test_deadline_bands(self):
+		for scheduling, expected in [("deadline", [0, 1]), ("deadline-global", [1, 0])]:
+			self.setUp()
+			self.a.scheduling = scheduling
+			flows = self._openFlows(rtws.PRI_FLASH, rtws.PRI_BULK)
+			flows[0].write(b"flash", endBy = 5)
+			flows[1].write(b"bulk", endBy = 1)
+			self.loop.run()
+			self.assertEqual(self._sendOrder(flows), expected, scheduling)
+
+	def test_deadline_global_no_deadline_band(self):
+		# a band whose earliest work has no deadline is ordered by priority: after an
+		# earlier deadline in a higher band, ahead of any deadline in a lower band
+		self.a.scheduling = "deadline-global"
+		flows = self._openFlows(rtws.PRI_FLASH_OVERRIDE, rtws.PRI_FLASH, rtws.PRI_BULK, rtws.PRI_BACKGROUND)
+		flows[3].write(b"background", endBy = 0.5)
+		flows[2].write(b"bulk", endBy = 1)
+		flows[1].write(b"flash")
+		flows[0].write(b"override", endBy = 2)
+		self.loop.run()
+		self.assertEqual(self._sendOrder(flows), [0, 1, 3, 2])
+
+	def test_deadline_priority_change_while_queued(self):
+		self.a.scheduling = "deadline"
+		flows = self._openFlows(rtws.PRI_ROUTINE, rtws.PRI_ROUTINE)
+		flows[0].write(b"a", endBy = 1)
+		flows[0].write(b"b", endBy = 1)
+		flows[1].write(b"c", endBy = 2)
+		flows[1].priority = rtws.PRI_FLASH
+		flows[1].priority = rtws.PRI_IMMEDIATE
+		self.loop.run()
+
+		self.assertEqual(self._sendOrder(flows), [1, 0, 0])
+		self.assertEqual(sorted(self.received), [(b"a", 1), (b"b", 2), (b"c", 1)])
+		for flow in flows:
+			self.assertIsNone(flow._deadlineEntry)
+		for heap in self.a._deadlineWork.values():
+			self.assertEqual([entry for entry in heap if entry[2] is not None], [])
+
+	def test_deadline_change_while_queued(self):
+		# requeueing a flow with a later deadline invalidates its earlier heap entry
+		self.a.scheduling = "deadline"
+		flows = self._openFlows(rtws.PRI_ROUTINE, rtws.PRI_ROUTINE)
+		flows[0].conflate = True
+		flows[0].write(b"first", endBy = 1)
+		flows[1].write(b"other", endBy = 5)
+		flows[0].write(b"replaced", endBy = 10)
+		self.loop.run()
+		self.assertEqual(self._sendOrder(flows), [1, 0])
+		self.assertEqual(sorted(self.received), [(b"other", 1), (b"replaced", 1)])
+
+	def test_deadline_scheduling_change_while_queued(self):
+		flows = self._openFlows(rtws.PRI_ROUTINE, rtws.PRI_ROUTINE)
+		flows[0].write(b"late", endBy = 2)
+		flows[1].write(b"early", endBy = 1)
+		self.a.scheduling = "deadline"
+		self.loop.run()
+		self.assertEqual(self._sendOrder(flows), [1, 0])
+
+		# back to round robin: the queued flows move out of the deadline heaps
+		self.aAdapter.sent = []
+		flows[0].write(b"late", endBy = 2)
+		flows[1].write(b"early", endBy = 1)
+		self.a.scheduling = "priority"
+		self.loop.run()
+		self.assertEqual(sorted(self._sendOrder(flows)), [0, 1])
+		self.assertEqual(sorted(self.received), [(b"early", 1), (b"early", 2), (b"late", 1), (b"late", 2)])
+		self.assertEqual([heap for heap in self.a._deadlineWork.values() if heap], [])
+		for flow in flows:
+			self.assertIsNone(flow._deadlineEntry)
+
+	def test_deadline_shedding_only_when_congested(self):
+		self.a.scheduling = "deadline"
+		flows = self._openFlows(rtws.PRI_ROUTINE)
+		self.a._bandwidth = 1000.0 # bytes per second
+		self.a._bandwidthTimestamp = time.time()
+
+		# idle: a late message is still sent
+		slow = flows[0].write(b"s" * 5000, endBy = 1)
+		self.loop.run()
+		self.assertTrue(slow.sent)
+
+		# congested: it can't finish by its deadline at the estimated bandwidth
+		self.a._flowBytesAcked -= self.a.outstandingThresh // 2
+		shed = flows[0].write(b"s" * 5000, endBy = 1)
+		onTime = flows[0].write(b"t" * 500, endBy = 1)
+		self.loop.run()
+		self.assertTrue(shed.abandoned)
+		self.assertTrue(onTime.sent)
+
+		# the estimate expires with the RTT history
+		self.a._bandwidthTimestamp = time.time() - self.a.rttHistoryThresh - 1
+		stale = flows[0].write(b"s" * 5000, endBy = 1)
+		self.loop.run()
+		self.assertTrue(stale.sent)
+		self.assertEqual(self.a._bandwidth, rtws.inf)
+
+	def test_delivery_priority_overtakes_backlog(self):
+		self.b.deliveryBudgetMessages = 4
+		flows = {}
+		def onrecvflow(recvFlow):
+			self._acceptFlow(recvFlow)
+			recvFlow.priority = rtws.PRI_FLASH if recvFlow.textMetadata == "control" else rtws.PRI_BULK
+			flows[recvFlow.textMetadata] = recvFlow
+		self.b.onrecvflow = onrecvflow
+		bulk = self.a.openFlow(b"bulk")
+		control = self.a.openFlow(b"control")
+		self.loop.run()
+
+		# the control message is sent only once bulk delivery has begun
+		onmessage = flows["bulk"].onmessage
+		def onBulkMessage(recvFlow, message, number):
+			if 1 == number:
+				control.write(b"urgent")
+			onmessage(recvFlow, message, number)
+		flows["bulk"].onmessage = onBulkMessage
+		for each in range(20):
+			bulk.write(b"bulk %d" % each)
+		self.loop.run()
+
+		messages = [message for message, number in self.received]
+		self.assertEqual(len(messages), 21)
+		self.assertEqual([each for each in messages if each != b"urgent"], [b"bulk %d" % each for each in range(20)])
+		position = messages.index(b"urgent")
+		self.assertGreater(position, 0)
+		self.assertLessEqual(position, 2 * self.b.deliveryBudgetMessages)
+
+	def test_delivery_priority_change_while_queued(self):
+		self.b.deliveryBudgetMessages = 3
+		changes = {2: rtws.PRI_FLASH, 4: rtws.PRI_BULK, 5: rtws.PRI_ROUTINE, 6: rtws.PRI_ROUTINE, 9: rtws.PRI_BACKGROUND}
+		def onrecvflow(recvFlow):
+			self._acceptFlow(recvFlow)
+			onmessage = recvFlow.onmessage
+			def _onmessage(flow, message, number):
+				onmessage(flow, message, number)
+				if number in changes:
+					flow.priority = changes[number]
+			recvFlow.onmessage = _onmessage
+		self.b.onrecvflow = onrecvflow
+		flows = self._openFlows(rtws.PRI_ROUTINE, rtws.PRI_ROUTINE)
+		for each in range(12):
+			flows[0].write(b"changing %d" % each)
+			flows[1].write(b"steady %d" % each)
+		self.loop.run()
+
+		for prefix in [b"changing", b"steady"]:
+			self.assertEqual([number for message, number in self.received if message.startswith(prefix)], list(range(1, 13)))
+		self.assertEqual(len(self.received), 24)
+		self.assertEqual([each for each in self.recvFlows if each.bufferLength], [])
+
+	def test_flow_close(self):
+		flow = self.a.openFlow(b"close")
+		flow.write(b"last words")
+		flow.close()
+		self.assertFalse(flow.isOpen)
+		self.loop.run()
+
+		self.assertEqual(self.received, [(b"last words", 1)])
+		self.assertEqual(self.completed, self.recvFlows)
+		self.assertFalse(self.recvFlows[0].isOpen)
+
+		closes = self.aAdapter.messages(rtws.MSG_FLOW_CLOSE)
+		self.assertEqual(closes, [bytes([rtws.MSG_FLOW_CLOSE]) + makeVLU(flow._flowID)])
+		closeAcks = self.bAdapter.messages(rtws.MSG_FLOW_CLOSE_ACK)
+		self.assertEqual(closeAcks, [bytes([rtws.MSG_FLOW_CLOSE_ACK]) + makeVLU(flow._flowID)])
+
+		# the final data ack precedes the close ack, then the flow ID is free for reuse
+		bCodes = self.bAdapter.codes()
+		self.assertLess(len(bCodes) - 1 - bCodes[::-1].index(rtws.MSG_DATA_ACK), bCodes.index(rtws.MSG_FLOW_CLOSE_ACK))
+		self.assertEqual(self.a._recvFlowsByID, {})
+		self.assertEqual(self.b._recvFlowsByID, {})
+		self.assertNotIn(flow._flowID, self.a._sendFlowsByID)
+		self.assertIn(flow._flowID, self.a._sendFlowFreeIDs)
+
+	def test_data_ack(self):
+		flow = self.a.openFlow(b"ack")
+		self.loop.run()
+		ackCount = len(self.bAdapter.messages(rtws.MSG_DATA_ACK))
+		flow.write(b"y" * 3000)
+		self.assertGreater(flow.bufferLength, 0)
+		self.loop.run()
+
+		acks = self.bAdapter.messages(rtws.MSG_DATA_ACK)[ackCount:]
+		self.assertTrue(acks)
+		total = 0
+		for each in acks:
+			cursor, flowID = parseVLU(each, 1)
+			cursor, deltaBytes = parseVLU(each, cursor)
+			cursor, advertisement = parseVLU(each, cursor)
+			self.assertEqual(cursor, len(each))
+			self.assertEqual(flowID, flow._flowID)
+			total += deltaBytes
+		sentBytes = sum(len(each) for each in self.aAdapter.sent if each[0] in [rtws.MSG_DATA_MORE, rtws.MSG_DATA_LAST])
+		self.assertEqual(total, sentBytes)
+		self.assertEqual(self.a.bytesInflight, 0)
+		self.assertEqual(flow.bufferLength, 0)
+
+	def test_paused_receiver_advertisement(self):
+		flow = self.a.openFlow(b"paused")
+		self.loop.run()
+		recvFlow = self.recvFlows[0]
+		recvFlow.paused = True
+		recvFlow.rcvbuf = 4000
+		flow.write(b"p" * 3000)
+		self.loop.run()
+		self.assertEqual(self.received, [])
+		self.assertLess(recvFlow.advertisement, 4000)
+		recvFlow.paused = False
+		self.loop.run()
+		self.assertEqual(self.received, [(b"p" * 3000, 1)])
+
+	def test_flow_exception(self):
+		exceptions = []
+		def onrecvflow(recvFlow):
+			self._acceptFlow(recvFlow)
+			recvFlow.close(7, "go away")
+		self.b.onrecvflow = onrecvflow
+		flow = self.a.openFlow(b"unwanted")
+		flow.onexception = lambda sendFlow, code, description: exceptions.append((sendFlow, code, description))
+		self.loop.run()
+
+		self.assertEqual(exceptions, [(flow, 7, "go away")])
+		self.assertFalse(flow.isOpen)
+		exceptionMessages = self.bAdapter.messages(rtws.MSG_FLOW_EXCEPTION)
+		self.assertEqual(exceptionMessages, [bytes([rtws.MSG_FLOW_EXCEPTION]) + makeVLU(flow._flowID) + makeVLU(7) + b"go away"])
+
+	def test_flow_not_accepted(self):
+		exceptions = []
+		self.b.onrecvflow = lambda recvFlow: None
+		flow = self.a.openFlow(b"ignored")
+		flow.onexception = lambda sendFlow, code, description: exceptions.append((code, description))
+		self.loop.run()
+		self.assertEqual(exceptions, [(0, "not accepted")])
+
+	def test_flow_exception_without_reason(self):
+		exceptions = []
+		flow = self.a.openFlow(b"bare")
+		flow.onexception = lambda sendFlow, code, description: exceptions.append((code, description))
+		self.loop.run()
+		self.a.adapter_onReceive(bytes([rtws.MSG_FLOW_EXCEPTION]) + makeVLU(flow._flowID))
+		self.assertEqual(exceptions, [(None, None)])
+
+	def test_compression_negotiated(self):
+		flow = self.a.openFlow(b"zlib", compression = "zlib")
+		message = b"compressible " * 500
+		flow.write(message)
+		self.loop.run()
+
+		self.assertEqual(flow.compression, "zlib")
+		self.assertEqual(self.recvFlows[0].compression, "zlib")
+		self.assertEqual(self.received, [(message, 1)])
+		self.assertEqual(self.aAdapter.codes().index(rtws.MSG_FLOW_COMPRESSION), 0)
+		self.assertEqual(self.bAdapter.codes()[0], rtws.MSG_FLOW_COMPRESSION_ACK)
+		self.assertLess(sum(len(each) for each in self.aAdapter.messages(rtws.MSG_DATA_LAST)), len(message))
+
+	def test_compression_declined(self):
+		# a peer that predates compression ignores the offer
+		onReceive = self.b.adapter_onReceive
+		self.b.adapter_onReceive = lambda message: None if message[0] == rtws.MSG_FLOW_COMPRESSION else onReceive(message)
+		flow = self.a.openFlow(b"zlib", compression = "zlib")
+		flow.write(b"plain")
+		self.loop.run()
+
+		self.assertIsNone(flow.compression)
+		self.assertEqual(self.received, [(b"plain", 1)])
+
+	def test_compression_offer_must_precede_open(self):
+		offer = lambda flowID: bytes([rtws.MSG_FLOW_COMPRESSION]) + makeVLU(flowID) + b"zlib\x00"
+		for flowID in range(1000):
+			self.b.adapter_onReceive(offer(flowID))
+		self.assertEqual(self.b._compressionOffer[0], 999)
+
+		# an offer followed by anything but its flow's open is dropped
+		self.b.adapter_onReceive(offer(5))
+		self.b.adapter_onReceive(bytes([rtws.MSG_PING]) + b"\x00" * 8)
+		self.assertIsNone(self.b._compressionOffer)
+		self.b.adapter_onReceive(bytes([rtws.MSG_FLOW_OPEN]) + makeVLU(5) + b"late")
+		self.b.adapter_onReceive(offer(7))
+		self.b.adapter_onReceive(bytes([rtws.MSG_FLOW_OPEN]) + makeVLU(6) + b"other")
+		self.b.adapter_onReceive(offer(8))
+		self.b.adapter_onReceive(bytes([rtws.MSG_FLOW_OPEN]) + makeVLU(8) + b"paired")
+
+		self.assertEqual([flow.compression for flow in self.recvFlows], [None, None, "zlib"])
+		self.assertEqual(self.bAdapter.messages(rtws.MSG_FLOW_COMPRESSION_ACK), [bytes([rtws.MSG_FLOW_COMPRESSION_ACK]) + makeVLU(8)])
+
+	def test_compression_declined_shared_and_submitted(self):
+		onReceive = self.b.adapter_onReceive
+		self.b.adapter_onReceive = lambda message: None if message[0] == rtws.MSG_FLOW_COMPRESSION else onReceive(message)
+		flow = self.a.openFlow(b"zlib", compression = "zlib")
+		shared = b"shared " * 500
+		receipt = rtws.writeToFlows([flow], shared)[flow]
+		submitted = flow.submit(b"submitted " * 500)
+		self.loop.run()
+
+		self.assertTrue(self.a.isOpen)
+		self.assertIsNone(flow.compression)
+		self.assertTrue(receipt.sent)
+		self.assertTrue(submitted.sent)
+		self.assertEqual(self.received, [(shared, 1), (b"submitted " * 500, 2)])
+
+	def test_unknown_message_ignored(self):
+		self.a.adapter_onReceive(b"\x7f\x01\x02")
+		self.a.adapter_onReceive(b"")
+		self.assertTrue(self.a.isOpen)
+
+	def test_protocol_error_closes(self):
+		self.a.adapter_onReceive(bytes([rtws.MSG_DATA_LAST]) + makeVLU(42) + b"no such flow")
+		self.assertFalse(self.a.isOpen)
+		self.assertTrue(self.aAdapter.closed)
+
+	def test_close(self):
+		exceptions = []
+		flow = self.a.openFlow(b"open")
+		flow.onexception = lambda sendFlow, code, description: exceptions.append(code)
+		self.loop.run()
+		self.a.close()
+		self.assertFalse(self.a.isOpen)
+		self.assertFalse(flow.isOpen)
+		self.assertEqual(len(exceptions), 1)
+		self.assertRaises(IOError, self.a.openFlow, b"closed")
+
+
+if __name__ == "__main__":
+	unittest.main()